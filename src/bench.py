@@ -0,0 +1,264 @@
+# Jukebox benchmark suite
+#
+# Description: Runs the reader and player benchmarks on a plain Linux machine, with
+#              the simulated RC522 (rc522_sim.py) standing in for the HAT and the fake
+#              Web API (fake_spotify.py) for Spotify, writes the results as JSON and
+#              compares them with the stored baseline (bench_baseline.json). Every
+#              metric is lower-is-better; a metric fails when it exceeds its baseline
+#              by more than its threshold (a fraction, e.g. 0.5 allows +50%). Counts
+#              such as SPI transfers are deterministic and have a threshold of 0.
+#              Times depend on the machine: record a baseline per machine with save.
+#
+# Usage: $ > python3 bench.py run [RESULTS-FILE]
+#        $ > python3 bench.py check [RESULTS-FILE] [THRESHOLD]
+#        $ > python3 bench.py save [RESULTS-FILE]
+
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import catalog
+import jukebox
+import module
+import poll_scheduler
+import rc522_sim
+import spotify_profile
+from player import PlayerStateMachine
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+RESULTS_PATH = 'bench_results.json'
+DEFAULT_THRESHOLD = 0.5   # +50% for metrics without a threshold of their own
+READS = 500
+IDLE_SECONDS = 2
+CATALOG_SIZES = (10, 1000, 100000)
+TAP_LATENCY = 0.01        # seconds the fake Web API takes per request
+READERS = 3               # simulated readers polled together by bench_readers
+STACK = 4                 # cards placed together for bench_stack
+
+
+def sim_reader(*cards):
+    """Rc522_api on the simulated reader, with the real 15 ms card timeout"""
+    rc = module.Rc522_api(rc522_sim.SimulatedRc522(*cards, timeout_time=0.015))
+    rc.init()
+    return rc
+
+
+def bench_read(reads=READS, card=None, name='rfid_read'):
+    """SPI transfers and microseconds per successful read() of a resting card"""
+    card = card or rc522_sim.MifareS50Card(blocks={8: range(16)})
+    rc = sim_reader(card)
+    transfers, seconds = [], []
+    while len(seconds) < reads:
+        card.power_off()  # a card left in place only answers every other REQA, see rc522_sim
+        rc.transport.reset_counters()
+        start = time.perf_counter()
+        ok = rc.read(rc.block_num)
+        elapsed = time.perf_counter() - start
+        if ok:
+            transfers.append(rc.transport.transfers)
+            seconds.append(elapsed)
+    return {name + '_transfers': statistics.mean(transfers),
+            name + '_us': statistics.median(seconds) * 1e6}
+
+
+def bench_read_ntag(reads=READS):
+    """bench_read for an NTAG213: 7 byte UID and no authentication"""
+    return bench_read(reads, rc522_sim.Ntag213Card(pages={4: range(4), 5: range(4), 6: range(4), 7: range(4)}),
+                      'rfid_read_ntag')
+
+
+def bench_stack(cards=STACK, polls=50):
+    """SPI transfers and milliseconds for the poll that reads a stack of cards placed
+    together, every one of them read and halted"""
+    stack = [rc522_sim.MifareS50Card(uid=(0x10 * i, 0xAD, 0xBE, 0xEF), blocks={8: range(16)})
+             for i in range(1, cards + 1)]
+    rc = sim_reader(*stack)
+    transfers, seconds = [], []
+    while len(seconds) < polls:
+        for card in stack:
+            card.power_off()
+        rc.present.clear()
+        rc.cache.clear()
+        rc.transport.reset_counters()
+        start = time.perf_counter()
+        events = rc.poll(rc.block_num)
+        elapsed = time.perf_counter() - start
+        if len(events) == cards:
+            transfers.append(rc.transport.transfers)
+            seconds.append(elapsed)
+    return {'rfid_stack_transfers': statistics.mean(transfers),
+            'rfid_stack_ms': statistics.median(seconds) * 1000}
+
+
+def bench_write(writes=READS):
+    """SPI transfers and microseconds per successful write() of block 8"""
+    card = rc522_sim.MifareS50Card()
+    rc = sim_reader(card)
+    data = '0123456789012345'
+    transfers, seconds = [], []
+    while len(seconds) < writes:
+        card.power_off()  # put it back in IDLE so every write starts from REQA
+        rc.transport.reset_counters()
+        start = time.perf_counter()
+        ok = rc.write(rc.block_num, data)
+        elapsed = time.perf_counter() - start
+        if ok:
+            transfers.append(rc.transport.transfers)
+            seconds.append(elapsed)
+    return {'rfid_write_transfers': statistics.mean(transfers),
+            'rfid_write_us': statistics.median(seconds) * 1e6}
+
+
+def bench_idle(seconds=IDLE_SECONDS):
+    """CPU use of the jukebox RFID loop with no card on the reader, in percent of one
+    core. The simulated reader runs in the same process and is included."""
+    rc = sim_reader()
+    box = jukebox.Jukebox(rc, None, None, None)
+
+    async def idle():
+        box.loop = asyncio.get_running_loop()
+        task = box.loop.create_task(box.rfid_task())
+        await asyncio.sleep(0.2)  # let the executor thread start
+        wall, cpu = time.perf_counter(), time.process_time()
+        await asyncio.sleep(seconds)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        task.cancel()
+        return cpu / wall * 100
+
+    try:
+        percent = asyncio.run(idle())
+    finally:
+        box.shutdown()
+    return {'idle_cpu_percent': percent}
+
+
+def bench_readers(readers=READERS, seconds=IDLE_SECONDS):
+    """milliseconds per poll of the slowest of several empty readers polled back to
+    back by the jukebox, the time one reader waits between two looks at its field"""
+    box = jukebox.Jukebox(None, None, None, None, poller=poll_scheduler.PollScheduler(0, 0),
+                          readers=[jukebox.Reader('reader%d' % i, sim_reader()) for i in range(readers)])
+
+    async def poll():
+        box.loop = asyncio.get_running_loop()
+        task = box.loop.create_task(box.rfid_task())
+        await asyncio.sleep(0.2)
+        polls = [r.polls for r in box.readers]
+        start = time.perf_counter()
+        await asyncio.sleep(seconds)
+        elapsed = time.perf_counter() - start
+        task.cancel()
+        return elapsed, [r.polls - n for r, n in zip(box.readers, polls)]
+
+    try:
+        elapsed, polls = asyncio.run(poll())
+    finally:
+        box.shutdown()
+    return {'readers_poll_ms': elapsed / min(polls) * 1000}
+
+
+def bench_catalog(sizes=CATALOG_SIZES):
+    """microseconds per catalog lookup for generated catalogs"""
+    results = {}
+    for entries in sizes:
+        albums = [{"id": "%022d" % i, "rfid": "%016d" % i, "artist": "Artist %d" % i, "title": "Album %d" % i}
+                  for i in range(entries)]
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(albums, f)
+        try:
+            albums = catalog.Catalog(f.name)
+        finally:
+            os.unlink(f.name)
+        keys = ["%016d" % (i * 7919 % entries) for i in range(10000)]
+        start = time.perf_counter()
+        for key in keys:
+            albums.lookup(key)
+        results['catalog_lookup_us_%d' % entries] = (time.perf_counter() - start) / len(keys) * 1e6
+    return results
+
+
+def bench_tap(taps=6, latency=TAP_LATENCY):
+    """tap-to-play through PlayerStateMachine.play_music against the fake Web API,
+    for taps with our device already active (the first and last tap are left out)"""
+    results = spotify_profile.profile_taps(PlayerStateMachine.play_music, taps, latency)[1:-1]
+    return {'tap_to_play_ms': statistics.median(r[0] for r in results) * 1000,
+            'tap_calls': statistics.mean(len(r[1]) for r in results)}
+
+
+def run():
+    results = {}
+    for benchmark in (bench_read, bench_read_ntag, bench_stack, bench_write, bench_idle, bench_readers, bench_catalog, bench_tap):
+        start = time.perf_counter()
+        results.update(benchmark())
+        print('%-14s %6.1f s' % (benchmark.__name__, time.perf_counter() - start), file=sys.stderr)
+    return {'time': time.time(), 'python': platform.python_version(), 'machine': platform.machine(),
+            'metrics': results}
+
+
+def check(results, baseline, threshold=None):
+    """compare results with the baseline, returns the list of failed metric names"""
+    failed = []
+    default = threshold if threshold is not None else baseline.get('threshold', DEFAULT_THRESHOLD)
+    for name, base in sorted(baseline['metrics'].items()):
+        value = results['metrics'].get(name)
+        if value is None:
+            print('%-24s missing' % name)
+            failed.append(name)
+            continue
+        limit = base.get('threshold', default)
+        change = (value - base['value']) / base['value'] if base['value'] else 0.0
+        ok = value <= base['value'] * (1 + limit) + 1e-9
+        print('%-24s %12.3f  baseline %12.3f  %+7.1f%%  (limit +%.0f%%)  %s' % (
+            name, value, base['value'], change * 100, limit * 100, 'ok' if ok else 'REGRESSION'))
+        if not ok:
+            failed.append(name)
+    return failed
+
+
+def save(results, path=BASELINE_PATH):
+    """store results as the new baseline, keeping the thresholds already configured"""
+    try:
+        with open(path) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {'threshold': DEFAULT_THRESHOLD, 'metrics': {}}
+    for name, value in results['metrics'].items():
+        baseline['metrics'].setdefault(name, {})['value'] = round(value, 3)
+    baseline['recorded'] = '%s, Python %s' % (results['machine'], results['python'])
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv):
+    mode = argv[1] if len(argv) > 1 else 'run'
+    path = argv[2] if len(argv) > 2 else RESULTS_PATH
+    if mode == 'run':
+        results = run()
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        for name, value in sorted(results['metrics'].items()):
+            print('%-24s %12.3f' % (name, value))
+        return 0
+    if mode == 'check':
+        with open(path) as f:
+            results = json.load(f)
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        failed = check(results, baseline, float(argv[3]) if len(argv) > 3 else None)
+        print('%d regression(s)' % len(failed))
+        return 1 if failed else 0
+    if mode == 'save':
+        with open(path) as f:
+            save(json.load(f))
+        return 0
+    print('Usage: python3 bench.py run|check|save [RESULTS-FILE] [THRESHOLD]')
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
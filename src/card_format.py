@@ -0,0 +1,87 @@
+# Direct-play card format
+#
+# Description: Cards written in this format carry the Spotify URI itself, so a tap
+#              starts playback without a catalog lookup, and can hold tracks,
+#              playlists, artists, shows and episodes as well as albums. The payload
+#              starts in the same block as the 16 digit catalog cards and continues in
+#              the next data block of the sector, so both are read in one
+#              authenticated session:
+#
+#                byte  0      MAGIC, never a digit, so old cards are told apart
+#                byte  1      format VERSION
+#                byte  2      URI type (TYPES)
+#                bytes 3-19   the 22 character base62 ID as a 17 byte big-endian number
+#                bytes 20-21  CRC_A over bytes 0-19
+#                bytes 22-31  zero
+#
+# Usage: $ > python3 card_format.py <SPOTIFY-URI>   (prints the encoded blocks)
+
+import sys
+
+import crc_a
+
+MAGIC = 0xD5
+VERSION = 1
+BLOCKS = 2            # data blocks used after the first one is read
+SIZE = BLOCKS * 16
+TYPES = ('album', 'track', 'playlist', 'artist', 'show', 'episode')
+BASE62 = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+ID_LENGTH = 22
+ID_BYTES = 17         # 62 ** 22 < 2 ** 136
+
+
+class CardFormatError(ValueError):
+    """not a Spotify URI the format can hold"""
+
+
+def is_direct(data):
+    """True when data (the first block at least) starts a direct-play payload"""
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode(uri):
+    """the SIZE byte payload for a spotify:<type>:<id> URI"""
+    parts = uri.split(':')
+    if len(parts) != 3 or parts[0] != 'spotify' or parts[1] not in TYPES:
+        raise CardFormatError('not a spotify:%s:<id> URI: %s' % ('|'.join(TYPES), uri))
+    id = parts[2]
+    if len(id) != ID_LENGTH or any(c not in BASE62 for c in id):
+        raise CardFormatError('not a %d character base62 id: %s' % (ID_LENGTH, id))
+    number = 0
+    for c in id:
+        number = number * 62 + BASE62.index(c)
+    payload = bytearray(SIZE)
+    payload[0:3] = MAGIC, VERSION, TYPES.index(parts[1])
+    payload[3:20] = number.to_bytes(ID_BYTES, 'big')
+    payload[20], payload[21] = crc_a.crc_a(payload, 20)
+    return bytes(payload)
+
+
+def decode(data):
+    """the Spotify URI of a direct-play payload, None when data is not one or is damaged"""
+    if len(data) < 22 or data[0] != MAGIC or data[1] != VERSION or data[2] >= len(TYPES):
+        return None
+    if tuple(data[20:22]) != crc_a.crc_a(data, 20):
+        return None
+    number = int.from_bytes(bytes(data[3:20]), 'big')
+    id = ''
+    for i in range(ID_LENGTH):
+        number, digit = divmod(number, 62)
+        id = BASE62[digit] + id
+    if number:
+        return None
+    return 'spotify:%s:%s' % (TYPES[data[2]], id)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: python3 card_format.py <SPOTIFY-URI>')
+        sys.exit(1)
+    try:
+        payload = encode(sys.argv[1])
+    except CardFormatError as e:
+        print('Error: ' + str(e))
+        sys.exit(1)
+    for i in range(BLOCKS):
+        print('block +%d: %s' % (i, payload[i * 16:(i + 1) * 16].hex(' ')))
+    print('decodes to ' + decode(payload))
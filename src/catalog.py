@@ -0,0 +1,179 @@
+# Album catalog
+#
+# Description: Maps RFID cards to Spotify albums. The catalog lives in a JSON file
+#              (a list of {"id", "rfid", "artist", "title"} objects, plus an optional
+#              "uid" with the card UID in hex) and is held in hash indexes keyed by
+#              the 16 digit card payload and by UID. Duplicate payloads or UIDs are
+#              rejected at load time. refresh() picks up edits to the file without a
+#              restart, applying only the entries that changed to the indexes.
+#
+# Usage: $ > python3 catalog.py check <CATALOG-FILE>
+#        $ > python3 catalog.py bench [ENTRIES]
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+class CatalogError(Exception):
+    """the catalog file is unreadable, malformed or has duplicate entries"""
+
+
+class Catalog(object):
+    def __init__(self, path):
+        self.path = path
+        self.by_rfid = {}
+        self.by_uid = {}
+        self.stamp = None  # (mtime, size) of the loaded file
+        self.last_check = 0
+        self.load()
+
+    def __len__(self):
+        return len(self.by_rfid)
+
+    def __iter__(self):
+        return iter(self.by_rfid.values())
+
+    def lookup(self, rfid, uid=None):
+        """album for a card payload, falling back to the card UID (bytes or hex string)"""
+        album = self.by_rfid.get(rfid)
+        if album is None and uid is not None:
+            album = self.by_uid.get(uid.hex() if isinstance(uid, (bytes, bytearray)) else uid.lower())
+        return album
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def _parse(self):
+        """read the file, returns {rfid: album} or raises CatalogError"""
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CatalogError('cannot read %s: %s' % (self.path, e))
+        if not isinstance(entries, list):
+            raise CatalogError('%s: needs a list of entries' % self.path)
+        albums = {}
+        uids = {}
+        problems = []
+        for n, entry in enumerate(entries):
+            if not isinstance(entry, dict) or not entry.get('id') or not entry.get('rfid'):
+                problems.append('entry %d: needs "id" and "rfid"' % n)
+                continue
+            rfid = str(entry['rfid'])
+            if rfid in albums:
+                problems.append('entry %d: rfid %s already used by %s' % (n, rfid, albums[rfid]['title']))
+                continue
+            uid = entry.get('uid')
+            if uid is not None and not isinstance(uid, str):
+                problems.append('entry %d: "uid" must be a hex string' % n)
+                continue
+            if uid:
+                uid = uid.lower()
+                if uid in uids:
+                    problems.append('entry %d: uid %s already used by %s' % (n, uid, uids[uid]['title']))
+                    continue
+                entry['uid'] = uid
+                uids[uid] = entry
+            entry['rfid'] = rfid
+            albums[rfid] = entry
+        if problems:
+            raise CatalogError('%s: %s' % (self.path, '; '.join(problems)))
+        return albums
+
+    def load(self):
+        """(re)build the indexes from the file, raises CatalogError"""
+        stamp = self._stat()
+        albums = self._parse()
+        self.by_rfid = albums
+        self.by_uid = dict((album['uid'], album) for album in albums.values() if album.get('uid'))
+        self.stamp = stamp
+
+    def refresh(self, min_interval=1.0):
+        """reload the file if it changed since the last call (checked at most every
+        min_interval seconds), returns the number of entries added, changed or removed.
+        A broken file is reported and the current catalog kept."""
+        now = time.monotonic()
+        if now - self.last_check < min_interval:
+            return 0
+        self.last_check = now
+        try:
+            stamp = self._stat()
+            if stamp == self.stamp:
+                return 0
+            albums = self._parse()
+        except (OSError, CatalogError) as e:
+            print("Error: catalog not reloaded: " + str(e))
+            return 0
+        changes = 0
+        for rfid in [rfid for rfid in self.by_rfid if rfid not in albums]:
+            self._remove(rfid)
+            changes += 1
+        for rfid, album in albums.items():
+            old = self.by_rfid.get(rfid)
+            if old != album:
+                if old is not None:
+                    self._remove(rfid)
+                self.by_rfid[rfid] = album
+                if album.get('uid'):
+                    self.by_uid[album['uid']] = album
+                changes += 1
+        self.stamp = stamp
+        if changes:
+            print("Catalog reloaded: %d change(s), %d albums" % (changes, len(self)))
+        return changes
+
+    def _remove(self, rfid):
+        album = self.by_rfid.pop(rfid)
+        if album.get('uid') and self.by_uid.get(album['uid']) is album:
+            del self.by_uid[album['uid']]
+
+
+def bench(entries=10000):
+    """load and lookup timings for a generated catalog against the old linear scan"""
+    albums = [{"id": "%022d" % i, "rfid": "%016d" % i, "uid": "%08x" % i,
+               "artist": "Artist %d" % i, "title": "Album %d" % i} for i in range(entries)]
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(albums, f)
+    try:
+        start = time.perf_counter()
+        catalog = Catalog(f.name)
+        print('load %d entries: %9.1f ms' % (entries, (time.perf_counter() - start) * 1000))
+
+        keys = ["%016d" % (i * 7919 % entries) for i in range(10000)]
+        start = time.perf_counter()
+        for key in keys:
+            catalog.lookup(key)
+        print('indexed lookup: %9.3f us' % ((time.perf_counter() - start) / len(keys) * 1e6))
+
+        legacy = dict(enumerate(albums))
+        scans = keys[:100]
+        start = time.perf_counter()
+        for key in scans:
+            for index in legacy:
+                if legacy[index]["rfid"] == key:
+                    break
+        print('linear scan:    %9.3f us' % ((time.perf_counter() - start) / len(scans) * 1e6))
+
+        albums[entries // 2]["title"] = "Changed"
+        with open(f.name, 'w') as out:
+            json.dump(albums, out)
+        os.utime(f.name, ns=(0, 0))  # make sure the stamp differs even on coarse clocks
+        start = time.perf_counter()
+        changes = catalog.refresh(min_interval=0)
+        print('hot reload:     %9.1f ms (%d change)' % ((time.perf_counter() - start) * 1000, changes))
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'check':
+        print('%d albums' % len(Catalog(sys.argv[2])))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    else:
+        print('Usage: python3 catalog.py check <CATALOG-FILE> | bench [ENTRIES]')
+        sys.exit(1)
@@ -0,0 +1,96 @@
+# Spotify RFID Jukebox
+#
+# Description: Button command queue. Presses only update a target (volume level,
+#              paused or playing) on the event loop; one worker per command type
+#              sends the latest target to Spotify and keeps going until the player
+#              state matches it. Rapid volume presses therefore collapse into one
+#              volume call with the final level, a double press of pause cancels
+#              out, and there is never more than one call of a type in flight. A target
+#              the state never reaches (a speaker that went away) is given up after
+#              SEND_ATTEMPTS calls.
+
+import feedback
+
+SEND_ATTEMPTS = 3  # calls sent for one target before giving up on it
+
+
+class CommandQueue(object):
+    def __init__(self, player, run, spawn, signals=None):
+        """player: PlayerStateMachine, run: coroutine function running a blocking player
+        method off the loop and returning its result, spawn: starts a background task"""
+        self.player = player
+        self.run = run
+        self.spawn = spawn
+        self.signals = signals
+        self.volume_target = None
+        self.volume_busy = False
+        self.paused_target = None
+        self.pause_busy = False
+        self.presses = 0  # button presses received
+        self.calls = 0  # Spotify calls issued for them
+
+    def volume_up(self):
+        self.volume_step(10)
+
+    def volume_down(self):
+        self.volume_step(-10)
+
+    def volume_step(self, step):
+        self.presses += 1
+        base = self.volume_target if self.volume_target is not None else self.player.STATE_VOLUME
+        if base < 0:
+            print("Volume not known yet")
+            return
+        target = min(max(base + step, 0), 100)
+        if target == base:
+            if self.signals is not None:
+                self.signals.play(feedback.VOLUME_LIMIT)
+            return
+        self.volume_target = target
+        if not self.volume_busy:
+            self.volume_busy = True
+            self.spawn(self._send_volume())
+
+    def pause(self):
+        """toggle between paused and playing"""
+        self.presses += 1
+        paused = self.paused_target if self.paused_target is not None else self.player.state == self.player.STATE_PAUSED
+        self.paused_target = not paused
+        if not self.pause_busy:
+            self.pause_busy = True
+            self.spawn(self._send_pause())
+
+    async def _send_volume(self):
+        sent, attempts = None, 0
+        try:
+            while self.volume_target is not None and self.volume_target != self.player.STATE_VOLUME:
+                if self.volume_target != sent:
+                    sent, attempts = self.volume_target, 0
+                if attempts == SEND_ATTEMPTS:
+                    print("Volume did not reach %d after %d calls" % (sent, attempts))
+                    break
+                attempts += 1
+                self.calls += 1
+                if not await self.run(self.player.apply_volume, self.volume_target):
+                    break
+        finally:
+            self.volume_target = None
+            self.volume_busy = False
+
+    async def _send_pause(self):
+        sent, attempts = None, 0
+        try:
+            while self.paused_target is not None and \
+                    self.paused_target != (self.player.state == self.player.STATE_PAUSED):
+                if self.paused_target != sent:
+                    sent, attempts = self.paused_target, 0
+                if attempts == SEND_ATTEMPTS:
+                    print("Playback did not %s after %d calls" % ("pause" if sent else "resume", attempts))
+                    break
+                attempts += 1
+                self.calls += 1
+                if not await self.run(self.player.set_paused, self.paused_target):
+                    break
+        finally:
+            self.paused_target = None
+            self.pause_busy = False
@@ -0,0 +1,42 @@
+# ISO/IEC 14443-A CRC
+#
+# Description: Table driven CRC_A (CRC-16/ISO-IEC-14443-3-A, reflected polynomial
+#              0x8408, preset 0x6363) as appended to every MIFARE frame after
+#              anticollision. Computing it on the Pi saves the RC522 CRC coprocessor
+#              round trip (FIFO load, PCD_CALCCRC, DivIrqReg wait, result read).
+#
+# Usage: $ > python3 crc_a.py   (checks the known frame vectors)
+
+CRC_A_PRESET = 0x6363
+
+
+def _table_entry(index):
+    crc = index
+    for bit in range(8):
+        crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+    return crc
+
+
+CRC_A_TABLE = tuple(_table_entry(i) for i in range(256))
+
+
+def crc_a(data, length=None):
+    """CRC_A over the first length bytes of data (all of it when None)
+    return : (low byte, high byte) in the order they are sent after the frame"""
+    if length is None:
+        length = len(data)
+    crc = CRC_A_PRESET
+    table = CRC_A_TABLE
+    for i in range(length):
+        crc = (crc >> 8) ^ table[(crc ^ data[i]) & 0xFF]
+    return crc & 0xFF, crc >> 8
+
+
+if __name__ == '__main__':
+    vectors = (([0x50, 0x00], (0x57, 0xCD)),  # HALT
+               ([0x30, 0x08], (0x4A, 0x24)),  # READ block 8
+               ([0x00, 0x00], (0xA0, 0x1E)))
+    for frame, expected in vectors:
+        result = crc_a(frame)
+        print('%s -> %02X %02X %s' % (bytes(frame).hex(), result[0], result[1],
+                                      'ok' if result == expected else 'FAIL'))
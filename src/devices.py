@@ -0,0 +1,261 @@
+# Spotify Connect devices
+#
+# Description: Addresses Connect devices by name instead of hard-coded ids, and drives
+#              a group of them at once. DeviceRegistry maps names to ids from an
+#              account's /me/player/devices list, cached for DEVICE_TTL seconds and
+#              looked up again early when a name is missing (a speaker that was just
+#              switched on). A Spotify account only plays on one device at a time, so
+#              every room of a group has its own PlayerStateMachine (and account).
+#              DeviceGroup sends one tap or button command to all the rooms on a
+#              bounded thread pool, reports the latency or failure per room, and can
+#              stand in for the player in the jukebox.
+#
+# Usage: $ > python3 devices.py bench [ROOMS] [LATENCY-MS]
+
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+DEVICE_TTL = 300      # seconds the device list is trusted
+MISS_INTERVAL = 10    # seconds between early lookups for a name that is not listed
+FANOUT_WORKERS = 4    # rooms driven at once
+
+
+class DeviceRegistry(object):
+    def __init__(self, fetch, ttl=DEVICE_TTL, clock=time.monotonic):
+        """fetch: returns the account's device objects, e.g. PlayerStateMachine.fetch_devices"""
+        self.fetch = fetch
+        self.ttl = ttl
+        self.clock = clock
+        self.devices = {}  # lower case name: device id
+        self.fetched = None  # clock time of the last lookup, None before the first
+
+    def expired(self):
+        return self.fetched is None or self.clock() - self.fetched >= self.ttl
+
+    def refresh(self):
+        devices = self.fetch()
+        self.devices = dict((device["name"].lower(), device["id"]) for device in devices)
+        self.fetched = self.clock()
+        return devices
+
+    def resolve(self, name):
+        """device id for name (case insensitive), None when the account has no such device"""
+        if self.expired() or (name.lower() not in self.devices and self.clock() - self.fetched >= MISS_INTERVAL):
+            self.refresh()
+        return self.devices.get(name.lower())
+
+
+class Room(object):
+    def __init__(self, name, player, registry=None):
+        """name: Connect device name, player: PlayerStateMachine of the account it belongs to"""
+        self.name = name
+        self.player = player
+        self.registry = registry if registry is not None else DeviceRegistry(player.fetch_devices)
+
+    def resolve(self):
+        """point the player at the device's current id, returns False if it is not listed"""
+        device_id = self.registry.resolve(self.name)
+        if device_id is None:
+            return False
+        self.player.device_id = device_id
+        return True
+
+
+class DeviceGroup(object):
+    """the player interface the jukebox and CommandQueue use, fanned out to every room.
+    Playback state (paused, volume) is read from the first room that succeeded in the
+    last fanout, so a room that is down does not hold the group's state back."""
+
+    STATE_PLAYING = 0
+    STATE_PAUSED = 1
+
+    def __init__(self, rooms, workers=FANOUT_WORKERS):
+        self.rooms = rooms
+        self.lead = rooms[0].player
+        self.source = self.lead  # player the group state is read from
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fanout')
+        self.results = []  # (room name, ok, seconds, error) of the last fanout
+
+    @property
+    def state(self):
+        return self.source.state
+
+    @property
+    def STATE_VOLUME(self):
+        return self.source.STATE_VOLUME
+
+    def _run(self, room, method, args):
+        start = time.perf_counter()
+        try:
+            if not room.resolve():
+                return room.name, False, time.perf_counter() - start, "device not found"
+            ok = getattr(room.player, method)(*args) is not False
+            return room.name, ok, time.perf_counter() - start, None if ok else "failed"
+        except Exception as e:
+            return room.name, False, time.perf_counter() - start, str(e)
+
+    def fanout(self, method, *args, rooms=None):
+        """call the player method on every room (or the given rooms) at once, returns True
+        if any succeeded"""
+        rooms = rooms if rooms is not None else self.rooms
+        futures = [self.pool.submit(self._run, room, method, args) for room in rooms]
+        self.results = [future.result() for future in futures]
+        report = []
+        for name, ok, seconds, error in self.results:
+            metrics.METRICS.observe("device_" + name, seconds)
+            if ok:
+                report.append("%s %.0f ms" % (name, seconds * 1000))
+            else:
+                metrics.count("device_failures")
+                report.append("%s failed after %.0f ms (%s)" % (name, seconds * 1000, error))
+        print("%s: %s" % (method, ", ".join(report)))
+        succeeded = [room.player for room, (name, ok, seconds, error) in zip(rooms, self.results) if ok]
+        self.source = succeeded[0] if succeeded else self.lead
+        return len(succeeded) > 0
+
+    def room(self, device_id):
+        """the room with this device name or id, None when the group has no such room"""
+        for room in self.rooms:
+            if device_id.lower() == room.name.lower() or device_id == room.player.device_id:
+                return room
+        return None
+
+    def play_music(self, id, resume, device_id=None):
+        """play on every room, or only on the room device_id names"""
+        if device_id is None:
+            return self.fanout("play_music", id, resume)
+        room = self.room(device_id)
+        if room is None:
+            print("Error: no room " + device_id)
+            return False
+        return self.fanout("play_music", id, resume, rooms=[room])
+
+    def set_paused(self, paused):
+        return self.fanout("set_paused", paused)
+
+    def apply_volume(self, volume):
+        return self.fanout("apply_volume", volume)
+
+    def fetch_albums(self, ids):
+        return self.lead.fetch_albums(ids)
+
+    def playback_expired(self):
+        return any(room.player.playback_expired() for room in self.rooms)
+
+    def refresh_playback(self):
+        for room in self.rooms:
+            if room.player.playback_expired():
+                room.player.refresh_playback()
+
+    def token_due(self):
+        return any(room.player.token_due() for room in self.rooms)
+
+    def refresh_token(self):
+        for room in self.rooms:
+            if room.player.token_due():
+                room.player.refresh_token()
+
+    def devices_due(self):
+        return any(room.registry.expired() for room in self.rooms)
+
+    def refresh_devices(self):
+        """look the device lists up again off the tap path"""
+        for room in self.rooms:
+            if room.registry.expired():
+                room.registry.refresh()
+
+    def close(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+async def press_volume(group):
+    """press volume up twice on a group, as the jukebox buttons do"""
+    import commands
+    loop = asyncio.get_running_loop()
+    tasks = []
+
+    async def run(method, *args):
+        return await loop.run_in_executor(None, method, *args)
+
+    queue = commands.CommandQueue(group, run, lambda coroutine: tasks.append(loop.create_task(coroutine)))
+    queue.volume_up()
+    queue.volume_up()
+    await asyncio.wait_for(asyncio.gather(*tasks), 10)
+
+
+def bench(rooms=3, latency=0.05):
+    """tap latency for a group of rooms against fake accounts, one room after the
+    other and fanned out, a tap routed to one room, then with one room failing and with the first room's
+    speaker switched off while the volume buttons are pressed"""
+    import fake_spotify
+    import spotify_http
+    from player import PlayerStateMachine
+    fakes = [fake_spotify.FakeSpotify(devices=[('%032x' % i, 'Room %d' % i)], latency=latency)
+             for i in range(rooms)]
+
+    def fresh_group(workers=FANOUT_WORKERS):
+        """rooms with nothing resolved or playing yet"""
+        PlayerStateMachine._instances.clear()
+        members = []
+        for i, fake in enumerate(fakes):
+            fake.active_device = None
+            session = spotify_http.SpotifySession()
+            player = PlayerStateMachine('Room %d' % i, sp=fake.client(requests_session=session), session=session)
+            members.append(Room('Room %d' % i, player))
+        return DeviceGroup(members, workers=workers)
+
+    try:
+        for workers in (1, FANOUT_WORKERS):
+            group = fresh_group(workers)
+            start = time.perf_counter()
+            group.play_music('0' * 22, False)
+            print('%d rooms, %d worker(s): tap played everywhere in %.0f ms' % (
+                rooms, workers, (time.perf_counter() - start) * 1000))
+            group.close()
+        group = fresh_group()
+        group.play_music('0' * 22, False, 'room 1')
+        print('tap routed to Room 1: played on %s' % ', '.join(
+            room.name for room, fake in zip(group.rooms, fakes) if fake.active_device is not None))
+        group.close()
+        group = fresh_group()
+        group.play_music('0' * 22, False)
+        fakes[-1].inject(503, count=20)
+        start = time.perf_counter()
+        ok = group.set_paused(True)
+        print('one room down: pause %s in %.0f ms' % (
+            'reached the others' if ok else 'failed', (time.perf_counter() - start) * 1000))
+        group.close()
+        del fakes[-1].faults[:]
+        group = fresh_group()
+        group.play_music('0' * 22, False)
+        for room in group.rooms:
+            room.player.STATE_VOLUME = 50
+        lead = fakes[0].devices
+        fakes[0].devices = []
+        group.rooms[0].registry.fetched = None
+        since = time.monotonic()
+        try:
+            asyncio.run(press_volume(group))
+        finally:
+            fakes[0].devices = lead
+        volume_calls = sum(1 for fake in fakes for request in fake.requests
+                           if request[0] >= since and request[2].endswith('/volume'))
+        print('first room down: 2 volume presses sent %d volume call(s), group volume %d' % (
+            volume_calls, group.STATE_VOLUME))
+        group.close()
+    finally:
+        for fake in fakes:
+            fake.close()
+        PlayerStateMachine._instances.clear()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 3, float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.05)
+    else:
+        print('Usage: python3 devices.py bench [ROOMS] [LATENCY-MS]')
+        sys.exit(1)
@@ -0,0 +1,200 @@
+# Fake Spotify Web API
+#
+# Description: A small in-process stand-in for the parts of the Spotify Web API the
+#              jukebox uses (the /me/player and /albums endpoints), served over real HTTP on
+#              127.0.0.1 so spotipy, requests and their connection handling are
+#              exercised unchanged. Every request can be delayed by a fixed latency.
+#              Like the real service, starting playback on a device that is not the
+#              active one fails with 404 NO_ACTIVE_DEVICE until it is transferred.
+#              One fake is one account: it lists its devices and plays on one at a time.
+#              A token endpoint hands out access tokens for the refresh_token grant.
+#              Faults (429 with Retry-After, 5xx, slow responses) can be queued up
+#              with inject() to exercise retries, timeouts and the circuit breaker.
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlsplit
+
+import spotipy
+
+import spotify_http
+
+
+class TimedSession(spotify_http.SpotifySession):
+    """SpotifySession that records (method, path, seconds, status) per call"""
+
+    def __init__(self):
+        super(TimedSession, self).__init__()
+        self.calls = []
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        status = None
+        try:
+            response = super(TimedSession, self).request(method, url, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.calls.append((method, urlsplit(url).path, time.perf_counter() - start, status))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like api.spotify.com
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def _dispatch(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if body and 'form-urlencoded' in self.headers.get('Content-Type', ''):
+            body = dict(parse_qsl(body.decode()))
+        else:
+            body = json.loads(body) if body else None
+        status, payload, headers = self.server.fake.respond(self.command, url.path, parse_qs(url.query), body)
+        data = json.dumps(payload).encode() if payload is not None else b''
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if data:
+                self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client timed out while we were delaying the answer
+
+    do_GET = do_PUT = do_POST = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSpotify(object):
+    def __init__(self, devices=('jukebox',), latency=0.0, port=0):
+        """devices: Connect device ids, or (id, name) pairs, latency: seconds added to every request"""
+        self.devices = [d if isinstance(d, str) else d[0] for d in devices]
+        self.names = dict((d, d) if isinstance(d, str) else d for d in devices)  # device id: name
+        self.latency = latency
+        self.active_device = None
+        self.is_playing = False
+        self.volume = 50
+        self.context_uri = None
+        self.albums = {}    # album id: album object served by /albums
+        self.requests = []  # (monotonic time, method, path)
+        self.played = []    # (monotonic time, device, context uri) whenever audio starts
+        self.faults = []    # [status or None, retry after, delay] served before real answers
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.url = 'http://127.0.0.1:%d/v1/' % self.server.server_address[1]
+        self.token_url = 'http://127.0.0.1:%d/api/token' % self.server.server_address[1]
+        self.token_lifetime = 3600
+        self.tokens_issued = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-spotify', daemon=True)
+        self.thread.start()
+
+    def client(self, **kwargs):
+        """spotipy client talking to this server"""
+        sp = spotipy.Spotify(auth='fake-token', **kwargs)
+        sp.prefix = self.url
+        return sp
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def inject(self, status=None, count=1, retry_after=None, delay=0.0):
+        """answer the next count requests with status (None: answer normally) after
+        delay seconds, adding a Retry-After header if given"""
+        with self.lock:
+            self.faults.extend([status, retry_after, delay] for _ in range(count))
+
+    def respond(self, method, path, query, body):
+        """returns (status, json payload or None, headers) for one request"""
+        with self.lock:
+            fault = self.faults.pop(0) if self.faults else None
+        if fault is not None:
+            status, retry_after, delay = fault
+            if delay:
+                time.sleep(delay)
+            if status is not None:
+                with self.lock:
+                    self.requests.append((time.monotonic(), method, path))
+                status, payload = self._error(status, 'Injected fault')
+                return status, payload, {'Retry-After': str(retry_after)} if retry_after is not None else {}
+        status, payload = self.handle(method, path, query, body)
+        return status, payload, {}
+
+    def _error(self, status, message, reason=None):
+        error = {'status': status, 'message': message}
+        if reason:
+            error['reason'] = reason
+        return status, {'error': error}
+
+    def _start(self, device):
+        self.is_playing = True
+        self.played.append((time.monotonic(), device, self.context_uri))
+
+    def handle(self, method, path, query, body):
+        """returns (status, json payload or None) for one request"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests.append((time.monotonic(), method, path))
+            device = query.get('device_id', [self.active_device])[0]
+            if method == 'GET' and path == '/v1/me/player':
+                if self.active_device is None:
+                    return 204, None
+                return 200, {'device': {'id': self.active_device, 'is_active': True,
+                                        'volume_percent': self.volume},
+                             'is_playing': self.is_playing,
+                             'context': {'uri': self.context_uri} if self.context_uri else None}
+            if method == 'GET' and path == '/v1/me/player/devices':
+                return 200, {'devices': [{'id': id, 'name': self.names[id], 'type': 'Speaker',
+                                          'is_active': id == self.active_device, 'volume_percent': self.volume}
+                                         for id in self.devices]}
+            if method == 'PUT' and path == '/v1/me/player':
+                device = body['device_ids'][0]
+                if device not in self.devices:
+                    return self._error(404, 'Device not found')
+                self.active_device = device
+                if body.get('play'):
+                    self._start(device)
+                return 204, None
+            if method == 'PUT' and path == '/v1/me/player/play':
+                if device is None or device != self.active_device:
+                    return self._error(404, 'Player command failed: No active device found', 'NO_ACTIVE_DEVICE')
+                if body and body.get('context_uri'):
+                    self.context_uri = body['context_uri']
+                elif body and body.get('uris'):
+                    self.context_uri = body['uris'][0]
+                self._start(device)
+                return 204, None
+            if method == 'PUT' and path == '/v1/me/player/pause':
+                if device is None or device != self.active_device:
+                    return self._error(404, 'Player command failed: No active device found', 'NO_ACTIVE_DEVICE')
+                self.is_playing = False
+                return 204, None
+            if method == 'PUT' and path == '/v1/me/player/volume':
+                if device is None or device != self.active_device:
+                    return self._error(404, 'Player command failed: No active device found', 'NO_ACTIVE_DEVICE')
+                self.volume = int(query['volume_percent'][0])
+                return 204, None
+            if method == 'POST' and path == '/api/token':
+                if not body or body.get('grant_type') != 'refresh_token':
+                    return 400, {'error': 'unsupported_grant_type'}
+                self.tokens_issued += 1
+                return 200, {'access_token': 'token-%d' % self.tokens_issued, 'token_type': 'Bearer',
+                             'expires_in': self.token_lifetime}
+            if method == 'GET' and path in ('/v1/albums', '/v1/albums/'):
+                ids = query.get('ids', [''])[0].split(',')
+                if len(ids) > 20:
+                    return self._error(400, 'Too many ids requested')
+                if not all(len(id) == 22 and id.isalnum() for id in ids):
+                    return self._error(400, 'invalid id')
+                return 200, {'albums': [self.albums.get(id) for id in ids]}
+            return self._error(404, 'Service not found')
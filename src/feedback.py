@@ -0,0 +1,109 @@
+# LED and buzzer feedback
+#
+# Description: Plays short LED/buzzer patterns on a background thread so the caller
+#              (the RFID loop, the card writer) never sleeps while the buzzer sounds.
+#              Patterns are timed steps; a new request always wins: it replaces any
+#              pattern still waiting and cuts the one that is playing short.
+#
+# Hardware: red LED on wiringpi pin 29 (active low), buzzer on soft PWM pin 24
+
+import threading
+import time
+
+SUCCESS      = 'success'
+UNKNOWN_CARD = 'unknown card'
+ERROR        = 'error'
+WRITING      = 'writing'
+VOLUME_LIMIT = 'volume limit'
+
+# pattern steps: (led on, buzzer level 0-8, seconds)
+PATTERNS = {
+    SUCCESS:      [(True, 5, 0.2)],
+    UNKNOWN_CARD: [(True, 3, 0.08), (False, 0, 0.08), (True, 3, 0.08)],
+    ERROR:        [(True, 1, 0.6)],
+    WRITING:      [(True, 0, 0.5), (False, 0, 0.5)] * 30,
+    VOLUME_LIMIT: [(False, 7, 0.05)],
+}
+
+
+class WiringPiPins(object):
+    """LED and soft PWM buzzer driven through wiringpi"""
+
+    def __init__(self, led_pin=29, buzzer_pin=24):
+        import wiringpi
+        self.wiringpi = wiringpi
+        self.led_pin = led_pin
+        self.buzzer_pin = buzzer_pin
+        wiringpi.wiringPiSetup()
+        wiringpi.pinMode(led_pin, 1)
+        wiringpi.softPwmCreate(buzzer_pin, 0, 8)
+
+    def led(self, on):
+        self.wiringpi.digitalWrite(self.led_pin, 0 if on else 1)  # red led is active low
+
+    def buzzer(self, level):
+        self.wiringpi.softPwmWrite(self.buzzer_pin, level)
+
+
+class FakePins(object):
+    """records (seconds, 'led'/'buzzer', value) instead of driving hardware"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.history = []
+
+    def led(self, on):
+        self.history.append((time.monotonic() - self.start, 'led', on))
+
+    def buzzer(self, level):
+        self.history.append((time.monotonic() - self.start, 'buzzer', level))
+
+
+class Feedback(object):
+    def __init__(self, pins):
+        self.pins = pins
+        self.cond = threading.Condition()
+        self.pending = None  # pattern name waiting to be played
+        self.playing = None
+        self.closed = False
+        self.worker = threading.Thread(target=self._run, name='feedback', daemon=True)
+        self.worker.start()
+
+    def play(self, name):
+        """start pattern name, interrupting whatever is playing; returns immediately"""
+        with self.cond:
+            self.pending = name
+            self.cond.notify()
+
+    def wait_idle(self, timeout=None):
+        """block until nothing is playing or pending, returns False on timeout"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.pending is None and self.playing is None, timeout)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.pending = None
+            self.cond.notify_all()
+        self.worker.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending is not None or self.closed)
+                if self.closed:
+                    break
+                self.playing, self.pending = self.pending, None
+            for led, level, seconds in PATTERNS[self.playing]:
+                self.pins.led(led)
+                self.pins.buzzer(level)
+                with self.cond:
+                    if self.cond.wait_for(lambda: self.pending is not None or self.closed, seconds):
+                        break  # latest request wins
+            self.pins.led(False)
+            self.pins.buzzer(0)
+            with self.cond:
+                self.playing = None
+                self.cond.notify_all()
+        self.pins.led(False)
+        self.pins.buzzer(0)
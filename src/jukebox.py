@@ -0,0 +1,341 @@
+# Spotify RFID Jukebox
+#
+# Description: asyncio core of the jukebox. The event loop owns the reader, the
+#              catalog and the button dispatch: RFID polling runs as a task with the
+#              SPI work on a dedicated thread, GPIO edges are handed to the loop with
+#              call_soon_threadsafe, and Spotify calls run on a bounded thread pool
+#              with a timeout, so a slow Web API request never holds up card
+#              detection or button handling. A jukebox can have several readers, each
+#              with its own catalog and Spotify device: every reader is polled from
+#              its own SPI thread, so one reader waiting out a card timeout never
+#              delays the others. The readers share one account, which plays on one
+#              device at a time: a tap moves playback to its reader's device and the
+#              buttons control whichever device is playing. A reader can also run in
+#              a process of its own (reader_process.py), the jukebox then only
+#              receives its card events and restarts it if it dies.
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import card_format
+import commands
+import devices
+import feedback
+import metadata
+import metrics
+import module
+import poll_scheduler
+import reader_process
+
+SPOTIFY_WORKERS = 4     # concurrent Spotify Web API calls
+SPOTIFY_TIMEOUT = 10    # seconds before we stop waiting for a Spotify call
+CATALOG_INTERVAL = 1    # seconds between catalog file checks
+PLAYBACK_INTERVAL = 1   # seconds between playback cache expiry checks
+METADATA_INTERVAL = 3600  # seconds between album metadata expiry checks
+TOKEN_INTERVAL = 30     # seconds between access token expiry checks
+DEVICES_INTERVAL = 60   # seconds between device list expiry checks of a device group
+SUPERVISE_INTERVAL = 1  # seconds between liveness checks of a reader process
+METRICS_INTERVAL = 15   # seconds between metrics file exports
+POLL_REPORT_INTERVAL = 300  # seconds between poll rate / CPU reports
+BUTTON_BOUNCE_MS = 50   # per-button contact bounce filter
+
+
+class Reader(object):
+    def __init__(self, name, rc, albums=None, device_id=None):
+        """one RC522 of the jukebox: name shown in messages, rc: Rc522_api or
+        reader_process.ReaderProcess,
+        albums: catalog.Catalog of its cards, the jukebox catalog when None,
+        device_id: Spotify device its cards play on, the player's device when None"""
+        self.name = name
+        self.rc = rc
+        self.albums = albums
+        self.device_id = device_id
+        self.polls = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spi-' + name)
+
+
+class Jukebox(object):
+    def __init__(self, rc, player, albums, signals, buttons=None, meta=None, metrics_path=None, poller=None,
+                 readers=None):
+        """rc: Rc522_api, player: PlayerStateMachine or devices.DeviceGroup, albums: catalog.Catalog
+        signals: feedback.Feedback, buttons: {GPIO pin (BOARD numbering): CommandQueue
+        method name, 'pause', 'volume_up' or 'volume_down'}, meta: metadata.MetadataCache
+        metrics_path: enables latency metrics, exported to metrics_path + '.prom' / '.json'
+        poller: poll_scheduler.PollScheduler, fast/slow RFID poll rates, shared by the readers
+        readers: list of Reader, replaces rc for a jukebox with several readers"""
+        self.readers = readers or [Reader('rfid', rc)]
+        for reader in self.readers:
+            if reader.albums is None:
+                reader.albums = albums
+        self.rc = self.readers[0].rc
+        self.player = player
+        self.albums = albums
+        self.meta = meta
+        self.signals = signals
+        self.buttons = buttons or {}
+        self.poller = poller if poller is not None else poll_scheduler.PollScheduler()
+        self.loop = None
+        self.spotify_executor = ThreadPoolExecutor(max_workers=SPOTIFY_WORKERS, thread_name_prefix='spotify')
+        self.tasks = set()
+        self.commands = commands.CommandQueue(player, self.spotify, self.spawn, signals)
+        self.metrics_path = metrics_path
+        if metrics_path is not None:
+            metrics.METRICS.enabled = True
+            metrics.METRICS.sources.append(lambda: {
+                "spi_transfers": sum(r.rc.transport.transfers for r in self.readers),
+                "spi_register_ops": sum(r.rc.transport.ops for r in self.readers)})
+
+    @property
+    def catalogs(self):
+        """the distinct catalogs of the readers"""
+        catalogs = []
+        for reader in self.readers:
+            if reader.albums is not None and not any(reader.albums is c for c in catalogs):
+                catalogs.append(reader.albums)
+        return catalogs
+
+    def spawn(self, coro):
+        """run coro as a background task, keeping a reference until it finishes"""
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def spotify(self, method, *args):
+        """run a blocking PlayerStateMachine method on the Spotify pool, returns its
+        result or None when it failed or timed out"""
+        name = getattr(method, '__name__', str(method))
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(self.loop.run_in_executor(self.spotify_executor, method, *args),
+                                   SPOTIFY_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Error: %s timed out after %d s" % (name, SPOTIFY_TIMEOUT))
+        except Exception as e:
+            print("Error: %s: %s" % (name, e))
+        else:
+            print("%s done in %.0f ms" % (name, (time.monotonic() - start) * 1000))
+            return result
+
+    def setup_gpio(self):
+        """route button edges from the RPi.GPIO callback thread into the event loop"""
+        import RPi.GPIO as GPIO
+        GPIO.setwarnings(False) # Ignore warning for now
+        GPIO.setmode(GPIO.BOARD) # Use physical pin numbering
+        for pin in self.buttons:
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN) # input pin pulled low (off)
+            GPIO.add_event_detect(pin, GPIO.RISING, bouncetime=BUTTON_BOUNCE_MS,
+                                  callback=lambda channel: self.loop.call_soon_threadsafe(self.button_pressed, channel))
+
+    def button_pressed(self, channel):
+        """runs on the event loop for every button edge, presses never wait on Spotify"""
+        command = self.buttons.get(channel)
+        self.poller.wake()  # someone is at the box, notice their next card quickly
+        for reader in self.readers:
+            if isinstance(reader.rc, reader_process.ReaderProcess):
+                reader.rc.wake()
+        if command is not None:
+            getattr(self.commands, command)()
+
+    def card_arrived(self, uid, data, polled=None, reader=None):
+        """polled: perf_counter time the poll that found the card started
+        reader: the Reader the card is on, the first one when None"""
+        reader = reader or self.readers[0]
+        uri = card_format.decode(data)
+        if uri is not None:
+            # direct-play card, the URI is on the card and needs no lookup
+            print(self.label(reader) + "read card:", uri)
+            self.signals.play(feedback.SUCCESS)
+            print("Playing " + uri + " on Spotify")
+            self.spawn(self.play(uri, polled, reader.device_id))
+            return
+        if card_format.is_direct(data):
+            print(self.label(reader) + "Damaged direct-play card", uid.hex())
+            self.signals.play(feedback.ERROR)
+            return
+        s = ""
+        for integer in data:
+            s += str(integer)
+        print(self.label(reader) + "read card:", s)
+        with metrics.stage("catalog_lookup"):
+            album = reader.albums.lookup(s, uid)
+        if album is None:
+            print("Unknown id")
+            self.signals.play(feedback.UNKNOWN_CARD)
+            return
+        if self.meta is not None and self.meta.is_dead(album["id"]):
+            print("Album id " + album["id"] + " is not on Spotify, check the catalog")
+            self.signals.play(feedback.ERROR)
+            return
+        self.signals.play(feedback.SUCCESS)
+        info = self.meta.get(album["id"]) if self.meta is not None else None
+        if info is not None:
+            print("Playing " + info["name"] + " by " + info["artist"] + " on Spotify")
+        else:
+            print("Playing " + album["artist"] + " on Spotify")
+        self.spawn(self.play(album["id"], polled, reader.device_id))
+
+    def label(self, reader):
+        """message prefix naming the reader, empty with a single reader"""
+        return reader.name + ": " if len(self.readers) > 1 else ""
+
+    async def play(self, id, polled, device_id=None):
+        if await self.spotify(self.player.play_music, id, False, device_id):
+            metrics.count("taps")
+            if polled is not None:
+                metrics.METRICS.observe("tap_to_play", time.perf_counter() - polled)
+        else:
+            metrics.count("failed_taps")
+
+    async def rfid_task(self):
+        await asyncio.gather(self.poll_report_task(), *[self.reader_task(reader) for reader in self.readers])
+
+    async def reader_task(self, reader):
+        # Only a newly placed card starts playback, a card left on the reader stays halted.
+        # Polls are paced by the scheduler: fast after activity, slow with the antenna
+        # off in between when idle
+        rc = reader.rc
+        if isinstance(rc, reader_process.ReaderProcess):
+            await self.remote_reader_task(reader)
+            return
+        while True:
+            polled = time.perf_counter()
+            events = await self.loop.run_in_executor(reader.executor, rc.poll, rc.block_num,
+                                                     self.poller.antenna_off())
+            reader.polls += 1
+            self.poller.polled(bool(events))
+            metrics.count("rfid_polls")
+            self.dispatch(reader, [(event, uid, data, polled) for event, uid, data in events])
+            await asyncio.sleep(max(0, self.poller.interval() - (time.perf_counter() - polled)))
+
+    async def remote_reader_task(self, reader):
+        # The reader process polls on its own, wait for its pipe to become readable and
+        # check that it is still alive every SUPERVISE_INTERVAL
+        remote = reader.rc
+        ready = asyncio.Event()
+        while True:
+            if not remote.supervise():
+                await asyncio.sleep(SUPERVISE_INTERVAL)
+                continue
+            fd = remote.fileno()
+            self.loop.add_reader(fd, ready.set)
+            try:
+                await asyncio.wait_for(ready.wait(), SUPERVISE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.loop.remove_reader(fd)
+            ready.clear()
+            events = remote.receive()
+            # count the process's polls in the poll report, its counters start over on a restart
+            polls = remote.transport.polls
+            self.poller.polls += polls - reader.polls if polls >= reader.polls else polls
+            reader.polls = polls
+            # polled is the reader's time.monotonic(), the same clock as perf_counter on Linux
+            offset = time.perf_counter() - time.monotonic()
+            self.dispatch(reader, [(event, uid, data, polled + offset if polled is not None else None)
+                                   for event, uid, data, polled in events])
+
+    def dispatch(self, reader, events):
+        """card events as (event, uid, data, perf_counter time of the poll). Of a stack of
+        cards found by the same poll only the first one plays, the others are reported"""
+        polls = set()
+        for event, uid, data, polled in events:
+            if event == module.CARD_REMOVED:
+                print(self.label(reader) + "card removed:", uid.hex())
+            elif polled in polls:
+                print(self.label(reader) + "card on the reader too, not played:", uid.hex())
+            else:
+                polls.add(polled)
+                self.card_arrived(uid, data, polled, reader)
+
+    async def poll_report_task(self):
+        while True:
+            await asyncio.sleep(POLL_REPORT_INTERVAL)
+            print("RFID polling: %.1f polls/s, %.1f%% CPU" % self.poller.report())
+
+    async def catalog_task(self):
+        await self.prefetch_metadata()
+        checked = time.monotonic()
+        while True:
+            await asyncio.sleep(CATALOG_INTERVAL)
+            changed = [albums.refresh(min_interval=0) for albums in self.catalogs]
+            if any(changed) or time.monotonic() - checked >= METADATA_INTERVAL:
+                await self.prefetch_metadata()
+                checked = time.monotonic()
+
+    async def prefetch_metadata(self):
+        """resolve catalog album ids that are new or expired in the metadata cache"""
+        if self.meta is None:
+            return
+        ids = [album["id"] for albums in self.catalogs for album in albums]
+        start = time.monotonic()
+        try:
+            requests, resolved, dead = await self.loop.run_in_executor(
+                None, metadata.prefetch, self.meta, ids, self.player.fetch_albums)
+        except Exception as e:
+            print("Error: album metadata not refreshed: " + str(e))
+            return
+        if requests:
+            print("Album metadata: %d resolved, %d dead, %d request(s) in %.0f ms" % (
+                resolved, dead, requests, (time.monotonic() - start) * 1000))
+        for album in (album for albums in self.catalogs for album in albums):
+            if self.meta.is_dead(album["id"]):
+                print("Warning: %s - %s has a dead album id %s" % (album.get("artist"), album.get("title"), album["id"]))
+
+    async def playback_task(self):
+        # Reconcile the cached playback state with Spotify once it expires, so
+        # buttons and taps read it without a request of their own
+        while True:
+            if self.player.playback_expired():
+                await self.spotify(self.player.refresh_playback)
+            await asyncio.sleep(PLAYBACK_INTERVAL)
+
+    async def token_task(self):
+        # Renew the access token before it expires, so the first tap after a long
+        # idle spell does not wait for a token request
+        while True:
+            if self.player.token_due():
+                await self.spotify(self.player.refresh_token)
+            await asyncio.sleep(TOKEN_INTERVAL)
+
+    async def devices_task(self):
+        # Keep the device names of a group resolved, so a tap does not wait for the list
+        if not isinstance(self.player, devices.DeviceGroup):
+            return
+        while True:
+            if self.player.devices_due():
+                await self.spotify(self.player.refresh_devices)
+            await asyncio.sleep(DEVICES_INTERVAL)
+
+    async def metrics_task(self):
+        if self.metrics_path is None:
+            return
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            try:
+                metrics.METRICS.write(self.metrics_path)
+            except OSError as e:
+                print("Error: metrics not written: " + str(e))
+
+    async def run(self, gpio=True):
+        self.loop = asyncio.get_running_loop()
+        if gpio:
+            self.setup_gpio()
+        try:
+            await asyncio.gather(self.rfid_task(), self.catalog_task(), self.playback_task(),
+                                 self.token_task(), self.devices_task(), self.metrics_task())
+        finally:
+            self.shutdown(wait=False)
+            self.signals.close()
+
+    def shutdown(self, wait=True):
+        """stop the SPI threads, the reader processes and the Spotify pool"""
+        for reader in self.readers:
+            reader.executor.shutdown(wait=wait)
+            if isinstance(reader.rc, reader_process.ReaderProcess):
+                reader.rc.close(wait=wait)
+        self.spotify_executor.shutdown(wait=wait)
+        if isinstance(self.player, devices.DeviceGroup):
+            self.player.close(wait=wait)
@@ -0,0 +1,164 @@
+# Album metadata cache
+#
+# Description: Resolves the catalog's album IDs through the Spotify albums endpoint
+#              (up to 20 IDs per request, a few requests at a time) and keeps the
+#              result in a JSON file next to the catalog, so a tap only reads local
+#              data: the album name and artist for display, and whether the ID is
+#              dead (unknown to Spotify or malformed) so it is not even tried.
+#              Entries expire after a week, dead ones after a day; prefetch() only
+#              requests IDs that are missing or expired.
+#
+# Usage: $ > python3 metadata.py bench [LATENCY-MS]
+
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import spotipy
+
+BATCH_SIZE = 20               # IDs per albums request, the endpoint's limit
+WORKERS = 2                   # albums requests in flight at once
+TTL = 7 * 24 * 3600           # seconds a resolved album is trusted
+DEAD_TTL = 24 * 3600          # seconds before a dead ID is looked up again
+
+
+class MetadataCache(object):
+    def __init__(self, path, ttl=TTL, dead_ttl=DEAD_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.dead_ttl = dead_ttl
+        self.clock = clock
+        self.albums = {}  # album id: {"name", "artist", "fetched", "dead"}
+        self.load()
+
+    def get(self, id):
+        """cached metadata for an album id, or None"""
+        return self.albums.get(id)
+
+    def is_dead(self, id):
+        entry = self.albums.get(id)
+        return entry is not None and entry["dead"]
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.albums = json.load(f)
+        except FileNotFoundError:
+            self.albums = {}
+        except (OSError, ValueError) as e:
+            print("Error: album metadata cache ignored: " + str(e))
+            self.albums = {}
+
+    def save(self):
+        """write the cache atomically, a crash never leaves a truncated file"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+            json.dump(self.albums, f)
+        os.replace(f.name, self.path)
+
+    def expired(self, ids):
+        """ids with no entry or an expired one, in order and without duplicates"""
+        now = self.clock()
+        stale = []
+        for id in dict.fromkeys(ids):
+            entry = self.albums.get(id)
+            if entry is None or now - entry["fetched"] >= (self.dead_ttl if entry["dead"] else self.ttl):
+                stale.append(id)
+        return stale
+
+    def store(self, ids, albums):
+        """record the albums endpoint answer for ids, a null answer marks the id dead"""
+        now = self.clock()
+        for id, album in zip(ids, albums):
+            if album is None:
+                self.albums[id] = {"name": None, "artist": None, "fetched": now, "dead": True}
+            else:
+                self.albums[id] = {"name": album.get("name"),
+                                   "artist": ", ".join(a["name"] for a in album.get("artists", [])),
+                                   "fetched": now, "dead": False}
+
+
+def fetch_batch(fetch, ids):
+    """albums for ids through fetch(ids), splitting the batch when Spotify rejects one
+    malformed id so the others still resolve. Returns (albums, requests made)."""
+    try:
+        return fetch(ids), 1
+    except spotipy.SpotifyException as e:
+        if e.http_status != 400:
+            raise
+    if len(ids) == 1:
+        return [None], 1
+    albums, requests = [], 1
+    for id in ids:
+        album, count = fetch_batch(fetch, [id])
+        albums.extend(album)
+        requests += count
+    return albums, requests
+
+
+def prefetch(cache, ids, fetch, batch_size=BATCH_SIZE, workers=WORKERS):
+    """resolve the missing or expired ids with fetch(list of ids) -> list of album
+    objects or None, saving the cache afterwards. A batch that fails is left for the
+    next prefetch. Returns (requests, resolved, dead)."""
+    stale = cache.expired(ids)
+    if not stale:
+        return 0, 0, 0
+    batches = [stale[i:i + batch_size] for i in range(0, len(stale), batch_size)]
+
+    def fetch_or_skip(batch):
+        try:
+            return fetch_batch(fetch, batch)
+        except Exception as e:
+            print("Error: " + str(e))
+            return None, 1
+
+    requests = 0
+    fetched = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='metadata') as pool:
+            for batch, (albums, count) in zip(batches, pool.map(fetch_or_skip, batches)):
+                requests += count
+                if albums is not None:
+                    cache.store(batch, albums)
+                    fetched.extend(batch)
+    finally:
+        cache.save()
+    dead = sum(1 for id in fetched if cache.is_dead(id))
+    return requests, len(fetched) - dead, dead
+
+
+def bench(latency=0.03):
+    """requests and time to resolve generated catalogs against the fake Web API"""
+    import fake_spotify
+    for entries in (22, 100, 1000):
+        ids = ["%022d" % i for i in range(entries)]
+        fake = fake_spotify.FakeSpotify(latency=latency)
+        fake.albums = dict((id, {"id": id, "name": "Album " + id, "artists": [{"name": "Artist"}]})
+                           for id in ids[1:])  # the first one is dead
+        sp = fake.client()
+        path = os.path.join(tempfile.mkdtemp(), 'albums-meta.json')
+        try:
+            for label, workers in (('cold, 1 worker ', 1), ('cold, %d workers' % WORKERS, WORKERS), ('warm', WORKERS)):
+                if label.startswith('cold') and os.path.exists(path):
+                    os.unlink(path)
+                cache = MetadataCache(path)
+                start = time.perf_counter()
+                requests, resolved, dead = prefetch(cache, ids, lambda b: sp.albums(b)["albums"], workers=workers)
+                print('%5d albums %s: %3d requests %8.1f ms (%d resolved, %d dead)' % (
+                    entries, label, requests, (time.perf_counter() - start) * 1000, resolved, dead))
+        finally:
+            fake.close()
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.03)
+    else:
+        print('Usage: python3 metadata.py bench [LATENCY-MS]')
+        sys.exit(1)
@@ -0,0 +1,216 @@
+# Tap latency metrics
+#
+# Description: Per-stage latency histograms and counters for the path from a card
+#              on the reader to music playing: the RC522 protocol steps, the catalog
+#              lookup, every Spotify call and the whole tap. Code marks a stage with
+#              the timed() decorator or a `with stage(name):` block; while metrics
+#              are disabled (the default) both cost one flag check. The collected
+#              data is exported as a Prometheus text file (for node_exporter's
+#              textfile collector) and as a JSON snapshot.
+#
+# Usage: $ > python3 metrics.py bench [READS]
+
+import functools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q quantile, None if empty or beyond the last bucket"""
+        if not self.count:
+            return None
+        for bound, total in zip(self.buckets, self.cumulative()):
+            if total >= q * self.count:
+                return bound
+        return None
+
+
+class _Stage(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class Metrics(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.sources = []  # callables returning {counter name: value} read at export time
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stage(self, name):
+        """context manager timing its block as stage name"""
+        return _Stage(self, name) if self.enabled else _NO_STAGE
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def _counters(self):
+        counters = dict(self.counters)
+        for source in self.sources:
+            counters.update(source())
+        return counters
+
+    def snapshot(self):
+        with self.lock:
+            stages = {}
+            for name, histogram in sorted(self.histograms.items()):
+                stages[name] = {"count": histogram.count, "sum": histogram.sum,
+                                "p50": histogram.quantile(0.5), "p95": histogram.quantile(0.95),
+                                "p99": histogram.quantile(0.99),
+                                "buckets": dict(zip([str(b) for b in histogram.buckets] + ["+Inf"],
+                                                    histogram.counts))}
+            return {"time": time.time(), "stages": stages, "counters": self._counters()}
+
+    def prometheus(self):
+        lines = ["# HELP jukebox_stage_seconds Time spent in each stage of a tap",
+                 "# TYPE jukebox_stage_seconds histogram"]
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                for bound, total in zip([repr(float(b)) for b in histogram.buckets] + ["+Inf"],
+                                        histogram.cumulative()):
+                    lines.append('jukebox_stage_seconds_bucket{stage="%s",le="%s"} %d' % (name, bound, total))
+                lines.append('jukebox_stage_seconds_sum{stage="%s"} %r' % (name, histogram.sum))
+                lines.append('jukebox_stage_seconds_count{stage="%s"} %d' % (name, histogram.count))
+            for name, value in sorted(self._counters().items()):
+                lines.append("# TYPE jukebox_%s_total counter" % name)
+                lines.append("jukebox_%s_total %d" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """atomically write path + '.prom' and path + '.json'"""
+        for suffix, text in ((".prom", self.prometheus()), (".json", json.dumps(self.snapshot(), indent=2))):
+            directory = os.path.dirname(os.path.abspath(path))
+            with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+                f.write(text)
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, path + suffix)
+
+
+METRICS = Metrics()
+
+
+def stage(name):
+    return METRICS.stage(name)
+
+
+def count(name, n=1):
+    METRICS.count(name, n)
+
+
+def timed(name):
+    """decorator timing every call of the function as stage name"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                METRICS.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def bench(reads=2000):
+    """cost of the instrumentation, disabled and enabled, on simulated card reads"""
+    import metrics  # the registry the driver reports to, not this script's __main__ copy
+    import module
+    import rc522_sim
+    rc = module.Rc522_api(rc522_sim.SimulatedRc522(rc522_sim.MifareS50Card(blocks={8: range(16)})))
+    rc.init()
+    for _ in range(reads):  # warm up
+        rc.read(rc.block_num)
+    for enabled in (False, True):
+        metrics.METRICS.reset()
+        metrics.METRICS.enabled = enabled
+        start = time.perf_counter()
+        for _ in range(reads):
+            rc.read(rc.block_num)
+        per_read = (time.perf_counter() - start) / reads
+        start = time.perf_counter()
+        for _ in range(100000):
+            with metrics.stage('bench'):
+                pass
+        per_stage = (time.perf_counter() - start) / 100000
+        print('metrics %-8s: %7.1f us per read, %5.0f ns per stage' % (
+            'enabled' if enabled else 'disabled', per_read * 1e6, per_stage * 1e9))
+    metrics.METRICS.enabled = False
+    for name, data in metrics.METRICS.snapshot()["stages"].items():
+        if name.startswith('rfid'):
+            print('  %-18s %6d calls, p50 <= %s s' % (name, data["count"], data["p50"]))
+    print('  rfid_auth_failures %6d' % metrics.METRICS.counters.get('rfid_auth_failures', 0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    else:
+        print('Usage: python3 metrics.py bench [READS]')
+        sys.exit(1)
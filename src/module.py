@@ -12,11 +12,12 @@
 #          MISO -> ON					ADR1 -> 0
 #          SCK  -> ON					ADR0 -> 0
 
-import serial
 import time
-import numpy as np
-import wiringpi
-import spidev
+from collections import OrderedDict
+
+import card_format
+import crc_a
+import metrics
 
 # the M1 card is divided into 16 sectors, each sector consists of four blocks(block0,block1,block2,block3)
 # the 64 blocks of 16 sectors are numbered by absolute address:0~63
@@ -38,7 +39,8 @@ PCD_RESETPHASE        = 0x0F    #reset
 PICC_REQIDL           = 0x26    #search cards that are not sleeping within the antenna
 PICC_REQALL           = 0x52    #search all cards in the antenna
 PICC_ANTICOLL1        = 0x93    #anti-collision
-PICC_ANTICOLL2        = 0x95    #anti-collision
+PICC_ANTICOLL2        = 0x95    #anti-collision, cascade level 2 (7 byte UIDs)
+PICC_CASCADE_TAG      = 0x88    #first UID byte at level 1 when the UID continues at level 2
 PICC_AUTHENT1A        = 0x60    #authenticate A key
 PICC_AUTHENT1B        = 0x61    #authenticate B key
 PICC_READ             = 0x30    #read block
@@ -48,9 +50,26 @@ PICC_INCREMENT        = 0xC1    #increase payment
 PICC_RESTORE          = 0xC2    #store block data to FIFO
 PICC_TRANSFER         = 0xB0    #save FIFO data
 PICC_HALT             = 0x50    #dormancy
+#Mifare Ultralight / NTAG21x card command, no authentication
+PICC_UL_WRITE         = 0xA2    #write one 4 byte page (READ is PICC_READ, 4 pages)
+PICC_UL_FAST_READ     = 0x3A    #read a range of pages in one frame (NTAG21x, Ultralight EV1)
+SAK_CASCADE           = 0x04    #SAK bit: UID not complete, select the next cascade level
+SAK_ULTRALIGHT        = 0x00    #SAK of Ultralight/NTAG21x (Classic 1K: 0x08, 4K: 0x18)
 #MF522 FIFO length
 DEF_FIFO_LENGTH       = 64      #FIFO size=64byte
-MAXRLEN  = 18
+MAXRLEN  = 34      #FAST_READ of 8 pages plus CRC, a Classic block read is 18
+#command completion wait
+TRANSCEIVE_TIMEOUT    = 0.025   #the maximum waiting time for operating the M1 card is 25 ms
+CRC_TIMEOUT           = 0.005
+ANTENNA_SETTLE        = 0.005   #a card needs 5 ms in the field to power up before it answers
+POLL_MIN_SLEEP        = 0.00005 #polling without IRQ pin: first sleep, doubled each poll
+POLL_MAX_SLEEP        = 0.001
+#anticollision
+MAX_CARDS             = 8       #new cards read by one poll, bounds the anticollision loop
+#CRC_A calculation
+CRC_SOFTWARE          = 0       #table driven on the Pi (default)
+CRC_HARDWARE          = 1       #RC522 CRC coprocessor
+CRC_CHECK             = 2       #both, counting mismatches
 #MF522 regsiter
 # PAGE 0
 RFU00                 = 0x00
@@ -120,11 +139,18 @@ RFU3C                 = 0x3C
 RFU3D                 = 0x3D
 RFU3E                 = 0x3E
 RFU3F                 = 0x3F
+# registers only changed by the host, Rc522_api keeps a shadow copy of these
+# so bit mask updates do not need to read the register back over SPI
+SHADOW_REGS = (ComIEnReg, DivlEnReg, WaterLevelReg, BitFramingReg, CollReg, ModeReg, TxModeReg,
+               RxModeReg, TxControlReg, TxAutoReg, TxSelReg, RxSelReg, RxThresholdReg, DemodReg,
+               MifareReg, SerialSpeedReg, ModWidthReg, RFCfgReg, GsNReg, CWGsCfgReg, ModGsCfgReg,
+               TModeReg, TPrescalerReg, TReloadRegH, TReloadRegL)
 
 #MF522 errno
 MI_OK                 = 0
 MI_NOTAGERR           = 1
 MI_ERR                = 2
+MI_COLLERR            = 3       #bit collision, the bits received before it are in the FIFO
 #SHAQU1                = 0x01
 #KUAI4                 = 0x04
 #KUAI7                 = 0x07
@@ -132,14 +158,26 @@ MI_ERR                = 2
 #CONSUME               = 0xa2
 READCARD              = 0xa3
 ADDMONEY              = 0xa4
+#card presence events returned by Rc522_api.poll
+CARD_ARRIVED          = 1
+CARD_REMOVED          = 2
 
 
 class Rc522_api(object):
-    def __init__(self):
-        self.CT = [0, 0]  # card type
-        self.SN = [0, 0, 0, 0]  # card serial number
-        self.RFID = [0, 0, 0, 0, 0, 0, 0, 0,
-                     0, 0, 0, 0, 0, 0, 0, 0]  # RFID
+    def __init__(self, transport=None, irq_pin=None, crc_mode=CRC_SOFTWARE, cache_size=64,
+                 bus=0, dev=0, reset_pin=25, led_pin=29, buzzer_pin=24):
+        """transport: register/GPIO backend, the Raspberry Pi SPI bus/dev (chip select) when None
+        (see rc522_transport and rc522_sim for capture, replay and simulation)
+        irq_pin: GPIO wired to the RC522 IRQ output, command completion then blocks on the
+        pin instead of polling ComIrqReg/DivIrqReg
+        crc_mode: CRC_SOFTWARE, CRC_HARDWARE or CRC_CHECK
+        cache_size: number of (UID, block) contents remembered by poll()
+        reset_pin, led_pin, buzzer_pin: wiringpi pins of this reader, None if not wired"""
+        self.CT = bytes(2)  # card type
+        self.SN = bytes(4)  # card serial number, 4 or 7 bytes
+        self.SAK = 0  # select acknowledge, tells MIFARE Classic from Ultralight/NTAG
+        self.RFID = bytes(16)  # RFID
+        self.frame = bytearray(MAXRLEN)  # frame buffer shared by all PCD/PICC commands
         self.total = 0
         self.KEY = [0xff, 0xff, 0xff, 0xff, 0xff, 0xff]
         self.AUDIO_OPEN = [0xAA, 0x07, 0x02, 0x00, 0x09, 0xBC]
@@ -148,49 +186,97 @@ class Rc522_api(object):
                         0,0,0,0,0,0,0,0]
         self.status = 0
         self.block_num = 0x08
-        self.bus = 0
-        self.dev = 0
+        self.page_num = 4  # Ultralight/NTAG page holding the card payload, the first user page
+        self.fast_read = True  # read the whole payload with FAST_READ, the original Ultralight lacks it
+        self.present = OrderedDict()  # UID -> missed polls, of the halted cards poll() is tracking
+        self.removal_polls = 2  # consecutive missed wake ups before a card counts as removed
+        self.collided = False  # the last pcd_anticoll had to resolve a collision, more cards answered
+        self.cache = OrderedDict()  # (UID, block) -> block contents, least recently used first
+        self.cache_size = cache_size
+        self.bus = bus
+        self.dev = dev
+        self.reset_pin = reset_pin
         self.spi_speed = 1000000
-        self.spi = spidev.SpiDev()
-        self.spi.open(self.bus, self.dev)
-        self.spi.max_speed_hz = self.spi_speed
-        self.spi.mode = 0b00
-        self.spi.xfer([1000000, 10, 8])
-
-        print('spi init')
-        wiringpi.wiringPiSetup()
-        wiringpi.pinMode(24, 1)  # buzzer pin
-        wiringpi.pinMode(25, 1)  # reset pin
-        wiringpi.pinMode(29, 1)  # led pin
-        wiringpi.digitalWrite(29,1)  # turn off red led
+        if transport is None:
+            import rc522_transport
+            transport = rc522_transport.SpiTransport(self.bus, self.dev, self.spi_speed)
+        self.transport = transport  # transport.transfers counts SPI transactions
+        self.shadow = {}  # last value written to SHADOW_REGS
+        self.irq_pin = irq_pin
+        self.crc_mode = crc_mode
+        self.crc_mismatches = 0
+        if irq_pin is not None:
+            self.transport.irq_setup(irq_pin)
+
+        if buzzer_pin is not None:
+            self.transport.pin_mode(buzzer_pin, 1)  # buzzer pin
+        if reset_pin is not None:
+            self.transport.pin_mode(reset_pin, 1)  # reset pin
+        if led_pin is not None:
+            self.transport.pin_mode(led_pin, 1)  # led pin
+            self.transport.digital_write(led_pin,1)  # turn off red led
 
     def write_rawrc(self, ucaddress, ucvalue):
         """"write rc522 register"""
-        addr = (ucaddress << 1) & 0x7E
-        self.spi.writebytes([addr,ucvalue])  #register addr(the lowest 6 bits are the actual address，MSB:1)
+        if ucaddress in SHADOW_REGS:
+            self.shadow[ucaddress] = ucvalue
+        self.transport.write_reg(ucaddress, ucvalue)
 
     def read_rawrc(self, ucaddress):
         """read current value from the register"""
-        addr = ((ucaddress <<1) & 0x7E) | 0x80
-        self.spi.writebytes([addr])
-        res = self.spi.readbytes(1)
-        return int.from_bytes(res, 'little')
+        return self.transport.read_reg(ucaddress)
+
+    def shadow_rawrc(self, ucaddress):
+        """current value of the register, from the shadow copy when we know it"""
+        if ucaddress in self.shadow:
+            return self.shadow[ucaddress]
+        value = self.read_rawrc(ucaddress)
+        if ucaddress in SHADOW_REGS:
+            self.shadow[ucaddress] = value
+        return value
+
+    def write_fifo(self, pindata, uclen):
+        """load uclen bytes into the FIFO in a single SPI transaction"""
+        self.transport.write_burst(FIFODataReg, memoryview(pindata)[:uclen])
 
     def clear_bitmask(self, ucreg, ucmask):
         """clear_bitmask clear RC522 register bit"""
-        uctemp = self.read_rawrc(ucreg)
+        uctemp = self.shadow_rawrc(ucreg)
         self.write_rawrc(ucreg, uctemp & (~ ucmask))  # clear bit mask
 
     def set_bitmask(self, ucreg, ucmask):
         """set_bitmask set bit for RC522 register"""
-        uctemp = self.read_rawrc(ucreg)
+        uctemp = self.shadow_rawrc(ucreg)
         self.write_rawrc(ucreg, uctemp | ucmask)  # set bit mask
 
+    def wait_irq(self, ucreg, ucwaitfor, timeout):
+        """wait until one of the ucwaitfor bits is set in ComIrqReg/DivIrqReg
+           blocks on the IRQ pin when it is wired, otherwise polls with a sleep that
+           doubles from POLL_MIN_SLEEP to POLL_MAX_SLEEP
+           return : register value, 0 on timeout
+        """
+        deadline = time.perf_counter() + timeout
+        delay = POLL_MIN_SLEEP
+        while True:
+            if self.irq_pin is not None:
+                if self.transport.irq_wait(max(deadline - time.perf_counter(), 0)):
+                    self.transport.irq_arm()  # re-arm before reading so a later edge is not lost
+            ucn = self.read_rawrc(ucreg)
+            if ucn & ucwaitfor:
+                return ucn
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return 0
+            if self.irq_pin is None:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, POLL_MAX_SLEEP)
+
     def pcd_antenna_on(self):
         """pcd_antenna_on :turn on the antenna"""
-        uc = self.read_rawrc(TxControlReg)
+        uc = self.shadow_rawrc(TxControlReg)
         if (uc & 0x03) == 0:
             self.set_bitmask(TxControlReg, 0x03)
+            time.sleep(ANTENNA_SETTLE)
 
     def pcd_antenna_off (self):
         """pcd_antenna_off turn off the antenna """
@@ -199,7 +285,7 @@ class Rc522_api(object):
     def pcd_config_iso_type(self, uctype):
         """set RC522 work mode"""
         if uctype == 'A':  # ISO14443_A
-            self.clear_bitmask(Status2Reg, 0x08)
+            self.write_rawrc(Status2Reg, 0x00)  # clear MFCrypto1On
             self.write_rawrc(ModeReg, 0x3D)  # 3F
             self.write_rawrc(RxSelReg, 0x86)  # 84
             self.write_rawrc(RFCfgReg, 0x7F)  # 4F
@@ -231,39 +317,45 @@ class Rc522_api(object):
         elif uccommand == PCD_TRANSCEIVE:  # receive and send
             ucirqen = 0x77  # enable TxIEn RxIEn IdleIEn LoAlertIEn ErrIEn TimerIEn
             ucwaitfor = 0x30  # time for Request and authenticate and check the RxIRq IdleIRq bit
-
-        self.write_rawrc(ComIEnReg, ucirqen | 0x80)  # IRqInv sets the pin IRQ to the opposite
-                                                    #value of the IRq bit of Status1Reg
-        self.clear_bitmask(ComIrqReg, 0x80)  # when Set1 bit were cleared，clear CommIRqReg mask bit
+        elif uccommand == PCD_TRANSMIT:  # send only, no answer expected
+            ucirqen = 0x43  # enable TxIEn ErrIEn TimerIEn
+            ucwaitfor = 0x40  # check the TxIRq bit
+
+        if self.irq_pin is not None:
+            # only completion, error and timer may pull the IRQ pin, TxIRq and LoAlertIRq would
+            # wake us before the card has answered
+            self.write_rawrc(ComIEnReg, ucwaitfor | 0x03 | 0x80)
+        else:
+            self.write_rawrc(ComIEnReg, ucirqen | 0x80)  # IRqInv sets the pin IRQ to the opposite
+                                                        #value of the IRq bit of Status1Reg
+        self.write_rawrc(ComIrqReg, 0x7F)  # when Set1 bit were cleared，clear all CommIRqReg bits
+        if self.irq_pin is not None:
+            self.transport.irq_arm()
         self.write_rawrc(CommandReg, PCD_IDLE)  # write IDLE command
-        self.set_bitmask(FIFOLevelReg, 0x80)  # set FlushBuffer to clear the read and write pointers of
+        self.write_rawrc(FIFOLevelReg, 0x80)  # set FlushBuffer to clear the read and write pointers of
                                              # the internal FIFO and the BufferOvfl flag of ErrReg is cleared
 
-        for i in range(ucinlenbyte):
-            data = int.from_bytes(pindata[i], 'little')
-            self.write_rawrc(FIFODataReg, data)  # write data to FIFO
+        self.write_fifo(pindata, ucinlenbyte)  # write data to FIFO
         self.write_rawrc(CommandReg, uccommand)  # write command
 
         if uccommand == PCD_TRANSCEIVE:
             self.set_bitmask(BitFramingReg, 0x80)  # StartSend is set to start data transmission. The bit
                                                   #is only valid when used with send and receive commands
 
-        ul = 1000  # adjusted according to the clock frequency, the maximum
-                   # waiting time for operating the M1 card is 25 ms
-        while ul > 0:
-            ucn = self.read_rawrc(ComIrqReg)
-            ul -= 1
-            if (ucn & 0x01) > 0 or (ucn & ucwaitfor) > 0:  # check event interrupt
-                break
+        ucn = self.wait_irq(ComIrqReg, ucwaitfor | 0x01, TRANSCEIVE_TIMEOUT)  # check event or timer interrupt
         self.clear_bitmask(BitFramingReg, 0x80)  # clear StartSend bit
-        if ul != 0:
-            if not(self.read_rawrc(ErrorReg) & 0x1B):  # read error flag:register BufferOfI CollErr ParityErr ProtocolErr
+        if ucn != 0:
+            # error flag, FIFO level and last bits in one transaction
+            ucerr, uclevel, uccontrol = self.transport.read_regs([ErrorReg, FIFOLevelReg, ControlReg])
+            if not(ucerr & 0x13):  # read error flag:register BufferOfI ParityErr ProtocolErr
                 cstatus = MI_OK
+                if ucerr & 0x08:  # CollErr, the bits up to the collision are still read out
+                    cstatus = MI_COLLERR
                 if (ucn & ucirqen & 0x01):  # time interrupt occurs
                     cstatus = MI_NOTAGERR
                 if uccommand == PCD_TRANSCEIVE:
-                    ucn = self.read_rawrc(FIFOLevelReg)  # read len from FIFO save data
-                    uclastbits = self.read_rawrc(ControlReg) & 0x07  # the number of valid bits of the last received byte
+                    ucn = uclevel  # read len from FIFO save data
+                    uclastbits = uccontrol & 0x07  # the number of valid bits of the last received byte
                     if (uclastbits):
                         poutlenbit = (ucn - 1) * 8 + uclastbits  # N bytes minus 1 (the last byte) + the number
                                                                  # of valid bits of the last received byte
@@ -273,12 +365,10 @@ class Rc522_api(object):
                         ucn = 1
                     if ucn > MAXRLEN:
                         ucn = MAXRLEN
-                    ul = 0
-                    for ul in range(ucn):
-                        poutdata[ul] = self.read_rawrc(FIFODataReg)
+                    poutdata[0:ucn] = bytes(self.transport.read_regs([FIFODataReg] * ucn))  # FIFO read out as a single burst
             else:
                 cstatus = MI_ERR
-        self.set_bitmask(ControlReg, 0x80)  # stop timer now
+        self.write_rawrc(ControlReg, 0x80)  # stop timer now
         self.write_rawrc(CommandReg, PCD_IDLE)
         return cstatus, poutlenbit
 
@@ -293,10 +383,10 @@ class Rc522_api(object):
             status = self.pcd_select()
         if status == MI_OK:  # select card success
             status = MI_ERR
-            status = self.pcd_authstate(0x60, 0x09)
+            status = self.auth_payload()
         if status == MI_OK:  # AuthState success
             status = MI_ERR
-            status = self.pcd_read(block_number)
+            status = self.read_payload(block_number)
         if status == MI_OK:  # read card success
             status = MI_ERR
             for i in range(16):
@@ -304,8 +394,156 @@ class Rc522_api(object):
             return True
         return False
 
+    def poll(self, block_number, antenna_off=False):
+        """card presence state machine, call once per loop iteration
+           new cards are read (or taken from the UID cache) and halted, every card in the
+           field in the same poll, while they stay on the reader each poll only wakes
+           them with WUPA, checks their UID and halts them again
+           antenna_off : switch the field off afterwards, the next poll switches it back on
+           return : list of (CARD_ARRIVED, uid, block data) and (CARD_REMOVED, uid, None)
+        """
+        events = self._poll(block_number)
+        if antenna_off:
+            self.pcd_antenna_off()
+        return events
+
+    def _poll(self, block_number):
+        events = []
+        search = not self.present
+        if len(self.present) == 1:
+            # a card resting on its own, as usual: wake it and if no other card answers, halt it again
+            uid = next(iter(self.present))
+            status = self.pcd_request(PICC_REQALL)
+            if status == MI_OK:
+                status = self.pcd_anticoll()
+                if status == MI_OK and self.SN == uid and not self.collided:
+                    self.present[uid] = 0
+                    if self.pcd_select() == MI_OK:
+                        self.pcd_halt()
+                    return events
+                # other cards answered too, anticoll left them half way: start them afresh
+                self.pcd_antenna_off()
+                search = True
+            else:
+                self.present[uid] += 1
+        if len(self.present) > 1 or (search and self.present):
+            # one WUPA and select per card, the others go back to sleep on the select
+            for uid in self.present:
+                if self.pcd_request(PICC_REQALL) == MI_OK and self.pcd_select_uid(uid) == MI_OK:
+                    self.pcd_halt()
+                    self.present[uid] = 0
+                else:
+                    self.present[uid] += 1
+            search = True
+        for uid, missed in list(self.present.items()):
+            if missed >= self.removal_polls:
+                del self.present[uid]
+                events.append((CARD_REMOVED, uid, None))
+        if search:
+            self.read_new(block_number, events)
+        return events
+
+    def read_new(self, block_number, events):
+        """read and halt the cards that are not halted, one per anticoll, until anticoll
+        no longer sees a collision (no other card answered) or MAX_CARDS are read"""
+        # WUPA also finds a card halted by someone else, but would wake the ones halted here
+        request = PICC_REQIDL if self.present else PICC_REQALL
+        for i in range(MAX_CARDS):
+            status = self.pcd_request(request)
+            if status == MI_OK:
+                status = self.pcd_anticoll()
+            if status != MI_OK:
+                return
+            if self.SN in self.present:  # not new, the field was off since the last poll
+                self.present[self.SN] = 0
+                if self.pcd_select() == MI_OK:
+                    self.pcd_halt()
+            else:
+                self.identify(block_number, events)
+            if not self.collided:
+                return
+            request = PICC_REQIDL
+
+    def cache_put(self, key, contents):
+        """remember contents for (UID, block), dropping the least recently used beyond cache_size"""
+        self.cache[key] = contents
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def identify(self, block_number, events):
+        """select the card in self.SN, get block_number from the cache or the card, then halt it"""
+        if self.pcd_select() != MI_OK:
+            return
+        key = (self.SN, block_number)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.RFID = self.cache[key]
+        elif self.auth_payload() == MI_OK and self.read_payload(block_number) == MI_OK:
+            self.cache_put(key, self.RFID)
+        else:
+            return
+        self.pcd_halt()
+        self.present[self.SN] = 0
+        for i in range(16):
+            self.card_id[i] = self.RFID[i]  # get RFID
+        events.append((CARD_ARRIVED, self.SN, self.RFID))
+
+    def is_ultralight(self):
+        """the selected card is a MIFARE Ultralight or NTAG21x, read and written by 4 byte
+        pages from page_num on without authentication"""
+        return self.SAK == SAK_ULTRALIGHT
+
+    def auth_payload(self):
+        """authenticate the sector holding the card payload, nothing to do for Ultralight/NTAG"""
+        if self.is_ultralight():
+            return MI_OK
+        return self.pcd_authstate(0x60, 0x09)
+
+    def read_payload(self, block_number):
+        """read the card payload starting at block_number of the authenticated sector into
+        self.RFID: the block itself, and the following blocks of a direct-play card.
+        On Ultralight/NTAG a single FAST_READ returns the largest payload"""
+        if self.is_ultralight() and self.fast_read:
+            cstatus = self.pcd_fast_read(self.page_num, self.page_num + card_format.SIZE // 4 - 1)
+            if cstatus == MI_OK and not card_format.is_direct(self.RFID):
+                self.RFID = self.RFID[0:16]
+            return cstatus
+        if self.is_ultralight():
+            first, step = self.page_num, 4
+        else:
+            first, step = block_number, 1
+        cstatus = self.pcd_read(first)
+        if cstatus != MI_OK or not card_format.is_direct(self.RFID):
+            return cstatus
+        payload = self.RFID
+        for i in range(1, card_format.BLOCKS):
+            cstatus = self.pcd_read(first + i * step)
+            if cstatus != MI_OK:
+                return cstatus
+            payload += self.RFID
+        self.RFID = payload
+        return MI_OK
+
+    def write_payload(self, block_number, data):
+        """write data (16 digits, or bytes filling one or more blocks) from block_number on,
+        within the authenticated sector, or page by page from page_num on Ultralight/NTAG"""
+        cstatus = MI_OK
+        size = 4 if self.is_ultralight() else 16
+        for i in range(0, len(data), size):
+            chunk = data[i:i + size]
+            if len(chunk) < size:
+                chunk = bytes(int(d) for d in chunk) + bytes(size - len(chunk))
+            if size == 4:
+                cstatus = self.pcd_write_page(self.page_num + i // 4, chunk)
+            else:
+                cstatus = self.pcd_write(block_number + i // 16, chunk)
+            if cstatus != MI_OK:
+                break
+        return cstatus
+
     def write(self, block_number, data):
-        """user write data to block"""
+        """user write data to block, data of more than 16 bytes continues in the next blocks"""
         if data == None:
             return False
         status = self.pcd_request(PICC_REQALL)  # Request card
@@ -317,15 +555,19 @@ class Rc522_api(object):
             status = self.pcd_select()
         if status == MI_OK:  # select card success
             status = MI_ERR
-            status = self.pcd_authstate(0x60, 0x09)
+            status = self.auth_payload()
         if status == MI_OK:  # AuthState success
             status = MI_ERR
-            status = self.pcd_write(block_number, data)
+            status = self.write_payload(block_number, data)
+        self.cache.pop((self.SN, block_number), None)
         if status == MI_OK:  # write card success
             print('write sucess')
+            if len(data) % 16 == 0:
+                self.cache_put((self.SN, block_number), bytes(int(d) for d in data))
             return True
         return False
 
+    @metrics.timed('rfid_request')
     def pcd_request(self, ucreq_code):
         """input  ：ucReq_code，Request card mode
            = 0x52，find all 14443A-compliant cards in the induction area
@@ -338,112 +580,195 @@ class Rc522_api(object):
            = 0x4403，Mifare_DESFire
           return: status MI_OK，sucess"""
         cstatus = 0
-        uccommf522buf = np.arange(0, MAXRLEN, 1)
+        uccommf522buf = self.frame
         ullen = 0
-        self.clear_bitmask(Status2Reg, 0x08)  # clear up the case in which the MIFARECyptol unit was
+        self.write_rawrc(Status2Reg, 0x00)  # clear up the case in which the MIFARECyptol unit was
                                              # turned on and all card data communications were encrypted
         self.write_rawrc(BitFramingReg, 0x07) # send the seven bits of the last byte
-        self.set_bitmask(TxControlReg, 0x03)  # the output signal of the TX1, TX2 pin transmits
-                                             # the modulated 13.56 energy carrier signal
+        self.pcd_antenna_on()  # the output signal of the TX1, TX2 pin transmits
+                               # the modulated 13.56 energy carrier signal
         uccommf522buf[0] = ucreq_code  # store card commmand word
         cstatus, ullen = self.pcd_com_mf522(PCD_TRANSCEIVE, uccommf522buf, 1, uccommf522buf)  # Request
-        if (cstatus == MI_OK) and (ullen == 0x10):  #Request success return card type
-            self.CT = uccommf522buf[0:2]
+        if (cstatus in (MI_OK, MI_COLLERR)) and (ullen == 0x10):  #Request success return card type
+            # cards of different types answer with different ATQA bits, that is no error
+            cstatus = MI_OK
+            self.CT = bytes(uccommf522buf[0:2])
         else:
             cstatus = MI_ERR
         return cstatus
 
+    @metrics.timed('rfid_anticoll')
     def pcd_anticoll(self):
         """card anticoll
-        get 4 bytes of card serial number
+        get 4 bytes of card serial number, or 7 bytes for a double size UID (NTAG21x,
+        Ultralight) whose level 1 is selected here to reach cascade level 2. With several
+        cards in the field one of them is singled out and self.collided is set
+        """
+        self.collided = False
+        cstatus, uid = self.pcd_anticoll_level(PICC_ANTICOLL1)
+        if cstatus == MI_OK and uid[0] == PICC_CASCADE_TAG:
+            cstatus = self.pcd_select_level(PICC_ANTICOLL1, uid)
+            if cstatus == MI_OK:
+                cstatus, uid2 = self.pcd_anticoll_level(PICC_ANTICOLL2)
+                if cstatus == MI_OK:
+                    self.SN = uid[1:4] + uid2
+            return cstatus
+        if cstatus == MI_OK:
+            self.SN = uid
+        return cstatus
+
+    def pcd_anticoll_level(self, level):
+        """anticoll at one cascade level, returns (status, the 4 UID bytes of the level)
+        where cards answer with different bits the RC522 reports the first one (CollReg),
+        the command is sent again with the UID bits up to it and a 1 there (NVB counts
+        them), so only the cards with a 1 carry on, until a single card answers
         """
-        uc = 0
-        ucSnr_check = 0
-        uccommf522buf = np.arange(0, MAXRLEN, 1)
+        uccommf522buf = self.frame
         ullen = 0
-        self.clear_bitmask(Status2Reg, 0x08)  # clear the MFCryptol On bit This bit can only be set
+        uid = None
+        known = bytearray(5)  # UID bytes and BCC of the level, as far as resolved
+        ucbits = 0  # bits of known sent with the command
+        self.write_rawrc(Status2Reg, 0x00)  # clear the MFCryptol On bit This bit can only be set
                                              # after a successful MFAuthent command is executed
         self.write_rawrc(BitFramingReg, 0x00)  # clear register  stop send and
         self.clear_bitmask(CollReg, 0x80)  # clear ValuesAfterColl all received bits are cleared after collision
-        uccommf522buf[0:2] = 0x93, 0x20  # Anticoll command
-        cstatus, ullen = self.pcd_com_mf522(PCD_TRANSCEIVE, uccommf522buf, 2, uccommf522buf)  # communicate to the card
+        while True:
+            ucbytes, uclastbits = divmod(ucbits, 8)
+            uclen = 2 + ucbytes + (1 if uclastbits else 0)
+            uccommf522buf[0] = level
+            uccommf522buf[1] = ((2 + ucbytes) << 4) | uclastbits  # NVB: whole bytes and bits sent
+            uccommf522buf[2:uclen] = known[0:uclen - 2]
+            cstatus, ullen = self.pcd_com_mf522(PCD_TRANSCEIVE, uccommf522buf, uclen, uccommf522buf)
+            if cstatus not in (MI_OK, MI_COLLERR):
+                break
+            # the answer goes on from the last bit sent: its first byte only holds bits RxAlign..7
+            ucmask = (0xFF << uclastbits) & 0xFF
+            known[ucbytes] = (known[ucbytes] & ~ucmask) | (uccommf522buf[0] & ucmask)
+            known[ucbytes + 1:5] = uccommf522buf[1:5 - ucbytes]
+            if cstatus == MI_OK:
+                break
+            ucn = self.read_rawrc(CollReg)
+            ucbit = ucbytes * 8 + (ucn & 0x1F or 32) - 1  # CollPos counts from bit 0 of the first FIFO byte
+            if (ucn & 0x20) or ucbit < ucbits or ucbit >= 32:  # CollPosNotValid, or not in the UID
+                cstatus = MI_ERR
+                break
+            known[ucbit // 8] |= 1 << (ucbit % 8)
+            ucbits = ucbit + 1
+            self.collided = True
+            self.write_rawrc(BitFramingReg, ((ucbits % 8) << 4) | (ucbits % 8))  # RxAlign, TxLastBits
+        if ucbits:
+            self.write_rawrc(BitFramingReg, 0x00)  # whole bytes again for select
         if cstatus == MI_OK:  #communition
-            for uc in range(4):
-                self.SN[uc] = uccommf522buf[uc]  #read UID
-                ucSnr_check ^= uccommf522buf[uc]
-            if ucSnr_check != uccommf522buf[uc+1]:
+            uid = bytes(known[0:4])  #read UID
+            if known[0] ^ known[1] ^ known[2] ^ known[3] != known[4]:
                 cstatus = MI_ERR
 
         self.set_bitmask(CollReg, 0x80)
-        return cstatus
+        return cstatus, uid
 
     def calulate_crc(self, pindata, uclen):
-        """alculate CRC16 with RC522"""
-        self.clear_bitmask(DivIrqReg, 0x04)
+        """calculate CRC_A of the first uclen bytes of pindata as selected by crc_mode
+           return : (low byte, high byte)"""
+        if self.crc_mode == CRC_SOFTWARE:
+            return crc_a.crc_a(pindata, uclen)
+        res = self.pcd_calulate_crc(pindata, uclen)
+        if self.crc_mode == CRC_CHECK:
+            soft = crc_a.crc_a(pindata, uclen)
+            if soft != res:
+                self.crc_mismatches += 1
+                print('CRC mismatch: RC522 %02x%02x, software %02x%02x' % (res + soft))
+        return res
+
+    def pcd_calulate_crc(self, pindata, uclen):
+        """calculate CRC16 with RC522"""
+        self.write_rawrc(DivIrqReg, 0x04)  # clear CRCIRq
+        if self.irq_pin is not None:
+            self.write_rawrc(ComIrqReg, 0x7F)  # release the shared IRQ pin held by the last transceive
+            self.transport.irq_arm()
         self.write_rawrc(CommandReg, PCD_IDLE)
-        self.set_bitmask(FIFOLevelReg, 0x80)
+        self.write_rawrc(FIFOLevelReg, 0x80)
 
-        for uc in range(uclen):
-            data = int.from_bytes(pindata[uc], 'little')
-            self.write_rawrc(FIFODataReg, data)
+        self.write_fifo(pindata, uclen)
         self.write_rawrc(CommandReg, PCD_CALCCRC)
-        uc = 0xFF
-        while uc > 0:
-            ucn = self.read_rawrc(DivIrqReg)
-            uc -= 1
-            if (ucn & 0x04) > 0:
-                break
-        res_l = self.read_rawrc(CRCResultRegL)
-        res_m = self.read_rawrc(CRCResultRegM)
+        self.wait_irq(DivIrqReg, 0x04, CRC_TIMEOUT)
+        res_l, res_m = self.transport.read_regs([CRCResultRegL, CRCResultRegM])
+        if self.irq_pin is not None:
+            self.write_rawrc(DivIrqReg, 0x04)  # release the IRQ pin for the next transceive
 
         return res_l, res_m
 
+    @metrics.timed('rfid_select')
     def pcd_select(self):
         """select card
-        card serial number is 4 bytes
+        card serial number is 4 bytes, a 7 byte one is selected at cascade level 2
+        (pcd_anticoll already selected level 1)
         """
-        uccommf522buf = np.arange(0, MAXRLEN, 1)
-        uccommf522buf[0] = PICC_ANTICOLL1
+        if len(self.SN) == 7:
+            return self.pcd_select_level(PICC_ANTICOLL2, self.SN[3:7])
+        return self.pcd_select_level(PICC_ANTICOLL1, self.SN)
+
+    def pcd_select_uid(self, uid):
+        """select a card by a UID read earlier, without anticoll, through both cascade
+        levels for a 7 byte UID. Cards with another UID leave the READY state"""
+        if len(uid) == 7:
+            cstatus = self.pcd_select_level(PICC_ANTICOLL1, bytes([PICC_CASCADE_TAG]) + uid[0:3])
+            if cstatus != MI_OK:
+                return cstatus
+            cstatus = self.pcd_select_level(PICC_ANTICOLL2, uid[3:7])
+        else:
+            cstatus = self.pcd_select_level(PICC_ANTICOLL1, uid)
+        if cstatus == MI_OK:
+            self.SN = uid
+        return cstatus
+
+    def pcd_select_level(self, level, uid):
+        """select the 4 UID bytes of one cascade level, keeps the card's SAK in self.SAK"""
+        uccommf522buf = self.frame
+        uccommf522buf[0] = level
         uccommf522buf[1] = 0x70
         uccommf522buf[6] = 0
         for uc in range(4):
-            uccommf522buf[uc + 2] = self.SN[uc]
-            uccommf522buf[6] ^= self.SN[uc]
+            uccommf522buf[uc + 2] = uid[uc]
+            uccommf522buf[6] ^= uid[uc]
 
         uccommf522buf[7], uccommf522buf[8] = self.calulate_crc(uccommf522buf, 7)
 
-        self.clear_bitmask(Status2Reg, 0x08)
+        self.write_rawrc(Status2Reg, 0x00)
 
         ucn, ullen = self.pcd_com_mf522(PCD_TRANSCEIVE, uccommf522buf, 9, uccommf522buf)
         if (ucn == MI_OK) and (ullen == 0x18):
             ucn = MI_OK
+            self.SAK = uccommf522buf[0]
         else:
             ucn = MI_ERR
 
         return ucn
 
+    @metrics.timed('rfid_auth')
     def pcd_authstate(self, ucauth_mode, ucaddr):
         """authenticate card key
         key authenticate mode = 0x60，authenticate A key
                               = 0x61，authenticate B key
         ucaddr is block addr
         """
-        uccommf522buf = np.arange(0, MAXRLEN, 1)
+        uccommf522buf = self.frame
         ullen = 0
         uccommf522buf[0:2] = ucauth_mode, ucaddr
         uccommf522buf[2:8] = self.KEY
-        uccommf522buf[8:12] = self.SN
+        uccommf522buf[8:12] = self.SN[-4:]  # the last cascade level of a 7 byte UID
 
         cstatus, ullen = self.pcd_com_mf522(PCD_AUTHENT, uccommf522buf, 12, uccommf522buf)
         if (cstatus != MI_OK) or (not(self.read_rawrc(Status2Reg) & 0x08)):
             cstatus = MI_ERR
+            metrics.count('rfid_auth_failures')
         return cstatus
 
+    @metrics.timed('rfid_write')
     def pcd_write(self, block_number, pdata):
         """write data to block of M1 card
         data length is 16 bytes
         """
-        uccommf522buf = np.arange(0, MAXRLEN, 1)
+        uccommf522buf = self.frame
         ullen = 0
         uccommf522buf[0:2] = PICC_WRITE, block_number
         uccommf522buf[2], uccommf522buf[3] = self.calulate_crc(uccommf522buf, 2)
@@ -453,36 +778,77 @@ class Rc522_api(object):
         if cstatus == MI_OK:
             uc = 0
             for uc in range(len(pdata)):
-                uccommf522buf[uc] = pdata[uc]
+                uccommf522buf[uc] = int(pdata[uc])  # digit strings store one digit per byte
             uccommf522buf[16], uccommf522buf[17] = self.calulate_crc(uccommf522buf, 16)
             cstatus, ullen= self.pcd_com_mf522(PCD_TRANSCEIVE, uccommf522buf, 18, uccommf522buf)
             if (cstatus != MI_OK) or (ullen != 4) or ((uccommf522buf[0] & 0x0F) != 0x0A):
                 cstatus = MI_ERR
         return cstatus
 
+    @metrics.timed('rfid_write')
+    def pcd_write_page(self, page, pdata):
+        """write 4 bytes to a page of an Ultralight/NTAG card, a single frame without
+        the two step exchange of the Classic WRITE"""
+        uccommf522buf = self.frame
+        uccommf522buf[0:2] = PICC_UL_WRITE, page
+        for uc in range(4):
+            uccommf522buf[uc + 2] = int(pdata[uc])
+        uccommf522buf[6], uccommf522buf[7] = self.calulate_crc(uccommf522buf, 6)
+        cstatus, ullen = self.pcd_com_mf522(PCD_TRANSCEIVE, uccommf522buf, 8, uccommf522buf)
+        if (cstatus != MI_OK) or (ullen != 4) or ((uccommf522buf[0] & 0x0F) != 0x0A):
+            cstatus = MI_ERR
+        return cstatus
+
+    @metrics.timed('rfid_read')
+    def pcd_fast_read(self, first, last):
+        """read pages first to last (at most 8) of an Ultralight EV1/NTAG card in one frame"""
+        uccommf522buf = self.frame
+        uccommf522buf[0:3] = PICC_UL_FAST_READ, first, last
+        uccommf522buf[3], uccommf522buf[4] = self.calulate_crc(uccommf522buf, 3)
+        cstatus, ullen = self.pcd_com_mf522(PCD_TRANSCEIVE, uccommf522buf, 5, uccommf522buf)
+        size = (last - first + 1) * 4
+        if (cstatus == MI_OK) and (ullen == (size + 2) * 8):
+            self.RFID = bytes(uccommf522buf[0:size])
+        else:
+            cstatus = MI_ERR
+        return cstatus
+
+    @metrics.timed('rfid_read')
     def pcd_read(self, block_number):
         """read block data from M1 card
         data length is 16 bytes
         """
-        uccommf522buf = np.arange(0, MAXRLEN, 1)
+        uccommf522buf = self.frame
         ullen = 0
         uccommf522buf[0:2] = PICC_READ, block_number
         uccommf522buf[2], uccommf522buf[3] = self.calulate_crc(uccommf522buf, 2)
         cstatus, ullen = self.pcd_com_mf522(PCD_TRANSCEIVE, uccommf522buf, 4, uccommf522buf)
 
         if (cstatus == MI_OK) and (ullen == 0x90):
-            self.RFID = uccommf522buf[0:16]
+            self.RFID = bytes(uccommf522buf[0:16])
         else:
             cstatus = MI_ERR
         return cstatus
 
+    @metrics.timed('rfid_halt')
+    def pcd_halt(self):
+        """put the selected card to sleep, it then only answers PICC_REQALL (WUPA)"""
+        uccommf522buf = self.frame
+        uccommf522buf[0:2] = PICC_HALT, 0
+        uccommf522buf[2], uccommf522buf[3] = self.calulate_crc(uccommf522buf, 2)
+        # the card does not answer HALT, only wait for the frame to be sent
+        cstatus, ullen = self.pcd_com_mf522(PCD_TRANSMIT, uccommf522buf, 4, uccommf522buf)
+        return cstatus
+
     def pcd_reset(self):
         """rc522 reset"""
-        wiringpi.digitalWrite(25,0)
-        time.sleep(0.001)
-        wiringpi.digitalWrite(25,1)
-        time.sleep(0.001)
+        if self.reset_pin is not None:
+            self.transport.digital_write(self.reset_pin,0)
+            time.sleep(0.001)
+            self.transport.digital_write(self.reset_pin,1)
+            time.sleep(0.001)
         self.write_rawrc(CommandReg, PCD_RESETPHASE)  # reset the rc522
+        self.shadow.clear()  # registers are back to their reset values
 
         while True:
             temp = self.read_rawrc(CommandReg)
@@ -498,6 +864,8 @@ class Rc522_api(object):
         self.write_rawrc(TModeReg, 0x8D)  # define the settings for the internal timer
         self.write_rawrc(TPrescalerReg, 0x3E)  # set the timer division factor
         self.write_rawrc(TxAutoReg, 0x40)  # the modulated transmit signal set to 100%ASK
+        if self.irq_pin is not None:
+            self.write_rawrc(DivlEnReg, 0x84)  # IRQPushPull, CRCIEn
 
     def init(self):
         """rc522 init"""
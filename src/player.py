@@ -0,0 +1,207 @@
+# Spotify RFID Jukebox
+#
+# Author: Ben Chacko, Hana Chacko 2024
+# Description: Playback state machine driving a single Spotify Connect device through
+#              the Spotify Web API (via Spotipy). Methods block on HTTP and may be
+#              called from worker threads; state changes are made under a lock.
+#              The playback state (playing/paused, volume, active device) is a cache:
+#              our own commands patch it as they succeed, and refresh_playback()
+#              reconciles it with Spotify once it is older than playback_ttl, so
+#              changes made from the phone app are picked up without any command
+#              having to fetch the state first. An account plays on one device at a
+#              time, so pause, resume and volume go to the active device, the one a
+#              tap last started (or the phone app moved playback to).
+
+import threading
+import time
+
+import spotipy
+from spotipy.oauth2 import SpotifyOAuth
+
+import feedback
+import spotify_auth
+import spotify_http
+
+# Time budgets in seconds for one call including its retries, kept below the
+# jukebox's own SPOTIFY_TIMEOUT so a call gives up before the jukebox stops waiting
+PLAY_BUDGET = 4
+BUTTON_BUDGET = 3
+REFRESH_BUDGET = 5
+
+
+# Singleton Class, one instance per device
+class PlayerStateMachine:
+  _instances = {}  # device id given to the constructor: state machine
+
+  STATE_PLAYING = 0
+  STATE_PAUSED = 1
+  STATE_VOLUME = -1
+
+  def __new__(cls, device_id, *args, **kwargs):
+    if device_id not in cls._instances:
+      print("Creating new state machine...")
+      cls._instances[device_id] = super(PlayerStateMachine, cls).__new__(cls)
+    return cls._instances[device_id]
+
+  def __init__(self, device_id, client_id=None, client_secret=None, cache_path=None, sp=None, signals=None,
+               playback_ttl=10, session=None, tokens=None):
+      self.device_id = device_id
+      self.signals = signals  # feedback.Feedback for errors
+      self.state = 0
+      self.albumId = 0
+      self.STATE_VOLUME = -1
+      self.active_device = None  # device Spotify last reported (or we made) active
+      self.playback = None  # last current_playback() payload
+      self.playback_time = 0  # monotonic time of the last refresh, 0 when invalid
+      self.playback_ttl = playback_ttl  # seconds before the cache is refreshed
+      self.patches = 0  # bumped by every local change, so a refresh racing it is dropped
+      self.lock = threading.Lock()
+
+      # Spotify Authentication, API and token requests share one keep-alive pool.
+      # The token is renewed ahead of expiry by the jukebox (see refresh_token)
+      if session is None:
+          session = spotify_http.SpotifySession()
+      if sp is None:
+          if tokens is None:
+              tokens = spotify_auth.TokenManager(SpotifyOAuth(
+                                            client_id=client_id,
+                                            client_secret=client_secret,
+                                            cache_handler=spotify_auth.AtomicCacheFileHandler(cache_path=cache_path),
+                                            redirect_uri="http://localhost:8080",
+                                            scope="user-read-playback-state,user-modify-playback-state",
+                                            requests_session=session,
+                                            requests_timeout=spotify_http.TIMEOUTS))
+          sp = spotipy.Spotify(auth_manager=tokens,
+                               requests_session=session,
+                               requests_timeout=spotify_http.TIMEOUTS)
+      self.sp = sp
+      self.tokens = tokens  # spotify_auth.TokenManager, None when sp brings its own auth
+      self.api = spotify_http.SpotifyCaller(session)
+
+  def signal(self, pattern):
+      if self.signals is not None:
+          self.signals.play(pattern)
+
+  def play_music(self, id, resume, device_id=None):
+      """start album id, or a spotify: URI from a direct-play card, on device_id (our device
+      when None), returns True when it is playing"""
+      uri = id if str(id).startswith("spotify:") else "spotify:album:" + str(id)
+      # tracks and episodes are played as a one item list, the others as a context
+      target = {"uris": [uri]} if uri.split(":")[1] in ("track", "episode") else {"context_uri": uri}
+      device_id = device_id or self.device_id
+      try :
+          # Transfer playback to the Raspberry Pi if music is playing on a different device,
+          # when it already is the active device the album can be started right away
+          if self.active_device != device_id:
+              self.transfer(resume, device_id)
+          try :
+              # Play the spotify track at URI with album ID
+              self.api.call(PLAY_BUDGET, self.sp.start_playback, device_id=device_id, **target)
+          except spotipy.SpotifyException as e:
+              if not self.device_not_active(e):
+                  raise
+              # The device went idle since we last used it
+              self.transfer(resume, device_id)
+              self.api.call(PLAY_BUDGET, self.sp.start_playback, device_id=device_id, **target)
+          with self.lock:
+              self.albumId = id
+          self.patch(state=self.STATE_PLAYING, device=device_id)
+          return True
+      except Exception as e:
+          print("Error: " + str(e))
+          self.signal(feedback.ERROR)
+          self.patch(state=self.STATE_PAUSED)
+          self.invalidate_playback()
+          return False
+
+  def transfer(self, resume, device_id=None):
+      device_id = device_id or self.device_id
+      self.api.call(PLAY_BUDGET, self.sp.transfer_playback, device_id=device_id, force_play=resume)
+      self.patch(device=device_id)
+
+  @staticmethod
+  def device_not_active(e):
+      return e.http_status == 404 and (e.reason == "NO_ACTIVE_DEVICE" or "active device" in str(e.msg))
+
+  def patch(self, state=None, volume=None, device=None):
+      """apply the effect of one of our own commands to the cached playback state"""
+      with self.lock:
+          self.patches += 1
+          if state is not None:
+              self.state = state
+          if volume is not None:
+              self.STATE_VOLUME = volume
+          if device is not None:
+              self.active_device = device
+
+  def invalidate_playback(self):
+      with self.lock:
+          self.playback_time = 0
+
+  def playback_expired(self):
+      return time.monotonic() - self.playback_time >= self.playback_ttl
+
+  def refresh_playback(self):
+      """fetch the playback state and reconcile the cache with it, unless one of our
+      commands changed the cache while the request was out"""
+      with self.lock:
+          patches = self.patches
+      data = self.api.call(REFRESH_BUDGET, self.sp.current_playback, market=None, additional_types=None)
+      device = (data or {}).get("device") or {}
+      with self.lock:
+          self.playback = data
+          self.playback_time = time.monotonic()
+          if patches != self.patches:
+              return data
+          self.active_device = device.get("id") if device.get("is_active") else None
+          if data is not None:
+              self.state = self.STATE_PLAYING if data.get("is_playing") else self.STATE_PAUSED
+          if device.get("volume_percent") is not None:
+              self.STATE_VOLUME = int(device["volume_percent"] / 10) * 10
+      return data
+
+  def token_due(self):
+      return self.tokens is not None and self.tokens.refresh_due()
+
+  def refresh_token(self):
+      """renew the access token ahead of expiry, off the tap path"""
+      self.tokens.refresh_if_due()
+
+  def fetch_devices(self):
+      """the account's Spotify Connect devices, as listed by /me/player/devices"""
+      return self.api.call(REFRESH_BUDGET, self.sp.devices)["devices"]
+
+  def fetch_albums(self, ids):
+      """album objects for up to 20 album ids, None for ids Spotify does not know"""
+      return self.api.call(REFRESH_BUDGET, self.sp.albums, ids)["albums"]
+
+  def set_paused(self, paused):
+      """pause or resume playback, returns True when Spotify accepted the request"""
+      try :
+          device_id = self.active_device or self.device_id
+          if paused:
+              print("Pausing playback...")
+              self.api.call(BUTTON_BUDGET, self.sp.pause_playback, device_id=device_id)
+          else:
+              print("Resuming playback...")
+              self.api.call(BUTTON_BUDGET, self.sp.transfer_playback, device_id=device_id, force_play=True)
+      except Exception as e:
+          print("Error: " + str(e))
+          self.signal(feedback.ERROR)
+          self.invalidate_playback()
+          return False
+      self.patch(state=self.STATE_PAUSED if paused else self.STATE_PLAYING)
+      return True
+
+  def apply_volume(self, volume):
+      """set the device volume, returns True when Spotify accepted the request"""
+      try :
+          self.api.call(BUTTON_BUDGET, self.sp.volume, volume, device_id=self.active_device or self.device_id)
+          print("Volume set to " + str(volume))
+      except Exception as e:
+          print("Error: " + str(e))
+          self.signal(feedback.ERROR)
+          self.invalidate_playback()
+          return False
+      self.patch(volume=volume)
+      return True
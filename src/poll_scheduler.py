@@ -0,0 +1,123 @@
+# RFID poll scheduler
+#
+# Description: Decides how often the reader is polled. Right after a card is seen or
+#              a button is pressed the reader is polled every fast_interval seconds;
+#              once nothing has happened for fast_period seconds it backs off to
+#              slow_interval and the antenna is switched off between polls, so an idle
+#              jukebox neither spins a core nor keeps the 13.56 MHz field up. The slow
+#              interval is the trade-off: it bounds the time to notice a new card
+#              against the CPU and power spent polling an empty field. The scheduler
+#              also keeps the effective poll rate and process CPU use for reporting.
+#
+# Usage: $ > python3 poll_scheduler.py sim [SLOW-MS ...]
+
+import asyncio
+import contextlib
+import io
+import random
+import sys
+import time
+
+FAST_INTERVAL = 0.05   # seconds between polls after activity
+SLOW_INTERVAL = 0.25   # seconds between polls when idle, bounds the detection latency
+FAST_PERIOD = 30       # seconds of fast polling after a card or a button press
+
+
+class PollScheduler(object):
+    def __init__(self, fast_interval=FAST_INTERVAL, slow_interval=SLOW_INTERVAL, fast_period=FAST_PERIOD,
+                 clock=time.monotonic):
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.fast_period = fast_period
+        self.clock = clock
+        self.fast_until = 0
+        self.polls = 0
+        self.window = (clock(), time.process_time(), 0)  # (start, cpu, polls) of the report window
+
+    @property
+    def fast(self):
+        return self.clock() < self.fast_until
+
+    def wake(self):
+        """a card or a button press, poll fast for the next fast_period seconds"""
+        self.fast_until = self.clock() + self.fast_period
+
+    def polled(self, found):
+        self.polls += 1
+        if found:
+            self.wake()
+
+    def interval(self):
+        return self.fast_interval if self.fast else self.slow_interval
+
+    def antenna_off(self):
+        """switch the field off after this poll, only worth it between slow polls"""
+        return not self.fast and self.slow_interval > self.fast_interval
+
+    def report(self):
+        """(polls per second, CPU percent of one core) since the last report"""
+        start, cpu, polls = self.window
+        now = self.clock()
+        self.window = (now, time.process_time(), self.polls)
+        elapsed = now - start
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (self.polls - polls) / elapsed, (time.process_time() - cpu) / elapsed * 100
+
+
+def simulate(slow_interval, cycles=10, idle=2.0):
+    """idle poll rate and CPU use, and the time to notice a card placed at a random
+    moment, for the jukebox RFID loop polling the simulated reader"""
+    import jukebox
+    import module
+    import rc522_sim
+
+    sim = rc522_sim.SimulatedRc522(timeout_time=0.015)
+    rc = module.Rc522_api(sim)
+    rc.init()
+    poller = PollScheduler(fast_interval=min(FAST_INTERVAL, slow_interval), slow_interval=slow_interval,
+                           fast_period=0)
+    box = jukebox.Jukebox(rc, None, None, None, poller=poller)
+    arrived = []
+    box.card_arrived = lambda uid, data, polled=None, reader=None: arrived.append(time.perf_counter())
+
+    async def run():
+        box.loop = asyncio.get_running_loop()
+        task = box.loop.create_task(box.rfid_task())
+        await asyncio.sleep(0.5)
+        poller.report()
+        await asyncio.sleep(idle)
+        rate, cpu = poller.report()
+        latencies = []
+        card = rc522_sim.MifareS50Card(blocks={8: range(16)})
+        for _ in range(cycles):
+            await asyncio.sleep(random.uniform(0, slow_interval))
+            placed = time.perf_counter()
+            sim.present(card)
+            while len(arrived) <= len(latencies):
+                await asyncio.sleep(0.001)
+            latencies.append(arrived[-1] - placed)
+            sim.remove(card)
+            while rc.present:
+                await asyncio.sleep(0.001)
+        task.cancel()
+        return rate, cpu, latencies
+
+    try:
+        return asyncio.run(run())
+    finally:
+        box.shutdown()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'sim':
+        intervals = [float(ms) / 1000 for ms in sys.argv[2:]] or [0, 0.05, 0.1, 0.25, 0.5]
+        print('slow interval   polls/s   idle cpu   detection mean / max')
+        for interval in intervals:
+            with contextlib.redirect_stdout(io.StringIO()):  # card removed messages
+                rate, cpu, latencies = simulate(interval)
+            print('%9.0f ms  %8.1f  %8.1f%%  %9.1f / %.1f ms' % (
+                interval * 1000, rate, cpu, sum(latencies) / len(latencies) * 1000, max(latencies) * 1000))
+    else:
+        print('Usage: python3 poll_scheduler.py sim [SLOW-MS ...]')
+        sys.exit(1)
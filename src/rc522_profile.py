@@ -0,0 +1,129 @@
+# RC522 driver profiler
+#
+# Description: Runs Rc522_api card reads against a real reader (optionally capturing
+#              a trace), a captured trace, or the simulated reader, and reports the
+#              register operations, SPI transfers, wall time and CPU time per read.
+#
+# Usage: $ > python3 rc522_profile.py capture <TRACE-FILE> [READS] [IRQ-PIN]
+#        $ > python3 rc522_profile.py replay <TRACE-FILE>
+#        $ > python3 rc522_profile.py sim [READS] [poll|irq] [CARD-RESPONSE-MS]
+#        $ > python3 rc522_profile.py frames [READS]
+#        $ > python3 rc522_profile.py crc [READS]
+
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import module
+import rc522_sim
+import rc522_transport
+
+
+def profile_reads(rc, reads=None, done=None):
+    """read rc.block_num repeatedly, returns a list of
+    (ok, register ops, transfers, seconds, cpu seconds) per read"""
+    results = []
+    while (reads is None or len(results) < reads) and not (done and done()):
+        rc.transport.reset_counters()
+        start = time.perf_counter()
+        cpu = time.process_time()
+        ok = rc.read(rc.block_num)
+        results.append((ok, rc.transport.ops, rc.transport.transfers,
+                        time.perf_counter() - start, time.process_time() - cpu))
+    return results
+
+
+def report(results):
+    ok = [r for r in results if r[0]]
+    print('reads: %d (%d ok)' % (len(results), len(ok)))
+    for label, rows in (('ok', ok), ('failed', [r for r in results if not r[0]])):
+        if rows:
+            ops = sum(r[1] for r in rows) / len(rows)
+            transfers = sum(r[2] for r in rows) / len(rows)
+            usec = sum(r[3] for r in rows) / len(rows) * 1e6
+            cpu_usec = sum(r[4] for r in rows) / len(rows) * 1e6
+            print('%-6s  %6.1f register ops/read  %6.1f transfers/read  %9.1f us/read  %9.1f cpu us/read'
+                  % (label, ops, transfers, usec, cpu_usec))
+
+
+def profile_frames(reads=1000):
+    """import time of module.py and per read allocation/CPU cost of the frame handling"""
+    command = [sys.executable, '-c', 'import time; t = time.perf_counter(); import module; '
+               'print(time.perf_counter() - t)']
+    runs = sorted(float(subprocess.run(command, capture_output=True, text=True, check=True).stdout)
+                  for i in range(5))
+    print('import module: %9.1f ms (median of 5)' % (runs[2] * 1000))
+
+    rc = module.Rc522_api(rc522_sim.SimulatedRc522(rc522_sim.MifareS50Card(blocks={8: range(16)})))
+    rc.init()
+    rc.read(rc.block_num)
+    start = time.process_time()
+    for i in range(reads):
+        rc.read(rc.block_num)
+    cpu = time.process_time() - start
+
+    tracemalloc.start()
+    peak = 0
+    for i in range(2):  # both the successful and the failed read of a present card
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        rc.read(rc.block_num)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    print('frames: %9.1f cpu us/read, %d bytes peak allocation/read' % (cpu / reads * 1e6, peak))
+
+
+def profile_crc(reads=1000):
+    """compare the software, RC522 and cross-checked CRC_A paths on the simulated reader"""
+    for name, crc_mode in (('software', module.CRC_SOFTWARE), ('hardware', module.CRC_HARDWARE),
+                           ('check', module.CRC_CHECK)):
+        rc = module.Rc522_api(rc522_sim.SimulatedRc522(rc522_sim.MifareS50Card(blocks={8: range(16)})),
+                              crc_mode=crc_mode)
+        rc.init()
+        print('crc %s:' % name)
+        report(profile_reads(rc, reads))
+        if crc_mode == module.CRC_CHECK:
+            print('mismatches: %d' % rc.crc_mismatches)
+
+
+def main(argv):
+    mode = argv[1] if len(argv) > 1 else 'sim'
+    done = None
+    irq_pin = None
+    if mode == 'capture':
+        transport = rc522_transport.CaptureTransport(rc522_transport.SpiTransport(), argv[2])
+        reads = int(argv[3]) if len(argv) > 3 else 20
+        irq_pin = int(argv[4]) if len(argv) > 4 else None
+    elif mode == 'replay':
+        transport = rc522_transport.ReplayTransport(argv[2])
+        irq_pin = transport.irq_pin
+        reads = None
+        done = lambda: transport.done
+    elif mode == 'frames':
+        profile_frames(int(argv[2]) if len(argv) > 2 else 1000)
+        return 0
+    elif mode == 'crc':
+        profile_crc(int(argv[2]) if len(argv) > 2 else 1000)
+        return 0
+    elif mode == 'sim':
+        reads = int(argv[2]) if len(argv) > 2 else 1000
+        irq_pin = 0 if len(argv) > 3 and argv[3] == 'irq' else None
+        response = float(argv[4]) / 1000 if len(argv) > 4 else 0.0
+        transport = rc522_sim.SimulatedRc522(rc522_sim.MifareS50Card(blocks={8: range(16)}),
+                                             response_time=response, timeout_time=0.015)
+    else:
+        print('Error: unknown mode ' + mode)
+        return 1
+
+    rc = module.Rc522_api(transport, irq_pin=irq_pin)
+    rc.init()
+    try:
+        report(profile_reads(rc, reads, done))
+    finally:
+        transport.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,467 @@
+# Simulated RC522 reader and MIFARE S50 card
+#
+# Description: Register level emulation of the RC522 (FIFO, command register,
+#              interrupt flags, CRC coprocessor, antenna) with a MIFARE Classic 1K
+#              card in its field. Plugged into Rc522_api as a transport it lets the
+#              full REQA -> anticoll -> select -> auth -> read/write sequence run on
+#              a plain Linux box. Ntag213Card is an NTAG213 with its 7 byte UID
+#              (cascade level 2), read and written by page without authentication.
+#              Any number of cards can be in the field: their answers are merged bit
+#              by bit, the first bit they differ in is reported in CollReg, and the
+#              cards answer anticoll frames with part of their UID sent (NVB), so the
+#              anticollision loop can single them out.
+#
+# Usage: rc = module.Rc522_api(rc522_sim.SimulatedRc522(rc522_sim.MifareS50Card()))
+#
+# Timing: response_time delays the completion of card commands and timeout_time the
+#         timer interrupt when no card answers, so polling and IRQ waits can be
+#         compared. The IRQ line follows ComIEnReg/DivIEnReg like the real pin.
+
+import time
+
+from module import (PCD_IDLE, PCD_CALCCRC, PCD_TRANSMIT, PCD_TRANSCEIVE, PCD_AUTHENT, PCD_RESETPHASE,
+                    PICC_REQIDL, PICC_REQALL, PICC_ANTICOLL1, PICC_ANTICOLL2, PICC_CASCADE_TAG,
+                    PICC_AUTHENT1A, PICC_READ, PICC_WRITE, PICC_UL_WRITE, PICC_UL_FAST_READ,
+                    PICC_HALT,
+                    CommandReg, ComIEnReg, DivlEnReg, ComIrqReg, DivIrqReg, ErrorReg, Status2Reg, FIFODataReg,
+                    FIFOLevelReg, ControlReg, BitFramingReg, CollReg, TxControlReg, CRCResultRegM,
+                    CRCResultRegL, VersionReg)
+from rc522_transport import Transport
+
+ACK = 0x0A
+NAK = 0x04
+
+
+def crc_a(data):
+    """ISO 14443-A CRC (preset 0x6363), returns (low, high)"""
+    crc = 0x6363
+    for b in data:
+        b ^= crc & 0xFF
+        b = (b ^ (b << 4)) & 0xFF
+        crc = (crc >> 8) ^ (b << 8) ^ (b << 3) ^ (b >> 4)
+    return crc & 0xFF, (crc >> 8) & 0xFF
+
+
+def check_crc(frame):
+    return len(frame) > 2 and crc_a(frame[:-2]) == (frame[-2], frame[-1])
+
+
+def to_bits(data, bits):
+    """the first bits of data in the order they are sent, least significant bit first"""
+    return [(data[i // 8] >> (i % 8)) & 1 for i in range(bits)]
+
+
+def from_bits(bits):
+    data = bytearray((len(bits) + 7) // 8)
+    for i, bit in enumerate(bits):
+        data[i // 8] |= bit << (i % 8)
+    return bytes(data)
+
+
+def is_anticoll(frame, level):
+    """an ANTICOLLISION frame of the cascade level, NVB below 0x70 (which is SELECT)"""
+    return len(frame) >= 2 and frame[0] == level and 0x20 <= frame[1] < 0x70
+
+
+def anticoll(frame, last_bits, uid):
+    """a card's answer to an ANTICOLLISION frame for uid (the 4 bytes of its level):
+    the UID and BCC bits after the ones the PCD sent, None when those are not ours"""
+    nbytes, nbits = (frame[1] >> 4) - 2, frame[1] & 0x0F
+    sent = nbytes * 8 + nbits
+    level = to_bits(bytes(uid) + bytes([uid[0] ^ uid[1] ^ uid[2] ^ uid[3]]), 40)
+    if nbits > 7 or len(frame) != 2 + nbytes + (1 if nbits else 0) or last_bits != nbits or sent > 32:
+        return None
+    if to_bits(frame[2:], sent) != level[:sent]:
+        return None
+    return from_bits(level[sent:]), 40 - sent
+
+
+class MifareS50Card(object):
+    """MIFARE Classic 1K: 4 byte UID, 16 sectors of 4 blocks, default transport keys"""
+
+    ATQA = bytes([0x04, 0x00])
+    SAK = 0x08
+
+    def __init__(self, uid=(0xDE, 0xAD, 0xBE, 0xEF), blocks=None):
+        self.uid = bytes(uid)
+        self.bcc = self.uid[0] ^ self.uid[1] ^ self.uid[2] ^ self.uid[3]
+        self.blocks = [bytearray(16) for i in range(64)]
+        self.blocks[0][0:7] = self.uid + bytes([self.bcc, self.SAK]) + self.ATQA
+        for sector in range(16):
+            self.blocks[sector * 4 + 3][:] = bytes([0xFF] * 6 + [0xFF, 0x07, 0x80, 0x69] + [0xFF] * 6)
+        for number, data in (blocks or {}).items():
+            self.blocks[number][:] = bytes(data)
+        self.state = 'IDLE'
+        self.woken = False  # woken from HALT by WUPA, an unexpected command puts it back to sleep
+        self.auth_sector = None
+        self.pending_write = None
+
+    def power_off(self):
+        self.state = 'IDLE'
+        self.woken = False
+        self.auth_sector = None
+        self.pending_write = None
+
+    def back(self):
+        """unexpected command in READY: back to IDLE, or to HALT if WUPA woke us"""
+        woken = self.woken
+        self.power_off()
+        if woken:
+            self.state = 'HALT'
+
+    def authenticate(self, mode, block, key, uid):
+        """returns True when key matches the sector trailer of block"""
+        trailer = self.blocks[(block // 4) * 4 + 3]
+        expected = trailer[0:6] if mode == PICC_AUTHENT1A else trailer[10:16]
+        if self.state != 'ACTIVE' or bytes(uid) != self.uid or bytes(key) != bytes(expected):
+            self.power_off()
+            return False
+        self.auth_sector = block // 4
+        return True
+
+    def transceive(self, frame, last_bits):
+        """handle one frame from the PCD, returns (response bytes, response bits) or None for no answer"""
+        if last_bits == 7 and len(frame) == 1:
+            if (frame[0] == PICC_REQIDL and self.state == 'IDLE') or \
+               (frame[0] == PICC_REQALL and self.state in ('IDLE', 'HALT')):
+                self.woken = self.state == 'HALT'
+                self.state = 'READY'
+                self.auth_sector = None
+                return self.ATQA, 16
+            if self.state in ('READY', 'ACTIVE'):
+                self.back()  # unexpected command
+            return None
+        if self.state == 'READY':
+            if is_anticoll(frame, PICC_ANTICOLL1):
+                return anticoll(frame, last_bits, self.uid)  # other cards' UID: stay silent in READY
+            if len(frame) == 9 and frame[0:2] == bytes([PICC_ANTICOLL1, 0x70]) and check_crc(frame) \
+                    and frame[2:6] == self.uid:
+                self.state = 'ACTIVE'
+                return bytes([self.SAK]) + bytes(crc_a([self.SAK])), 24
+            self.back()
+            return None
+        if self.state != 'ACTIVE':
+            return None
+        if self.pending_write is not None:
+            block, self.pending_write = self.pending_write, None
+            if len(frame) != 18 or not check_crc(frame):
+                return bytes([NAK]), 4
+            self.blocks[block][:] = frame[0:16]
+            return bytes([ACK]), 4
+        if not check_crc(frame):
+            self.power_off()
+            return None
+        if frame[0] == PICC_HALT:
+            self.state = 'HALT'
+            self.auth_sector = None
+            return None
+        if frame[0] in (PICC_READ, PICC_WRITE):
+            block = frame[1]
+            if block >= 64 or self.auth_sector != block // 4:
+                self.power_off()
+                return bytes([NAK]), 4
+            if frame[0] == PICC_READ:
+                data = bytes(self.blocks[block])
+                return data + bytes(crc_a(data)), 144
+            if block == 0:
+                return bytes([NAK]), 4
+            self.pending_write = block
+            return bytes([ACK]), 4
+        self.power_off()
+        return None
+
+
+class Ntag213Card(object):
+    """NTAG213: 7 byte UID selected in two cascade levels, 45 pages of 4 bytes, user
+    memory in pages 4-39, READ returns 4 pages, FAST_READ a range and WRITE (0xA2) takes one"""
+
+    ATQA = bytes([0x44, 0x00])
+    SAK_LEVEL1 = 0x04  # UID not complete
+    SAK = 0x00
+    PAGES = 45
+
+    def __init__(self, uid=(0x04, 0x12, 0x34, 0x56, 0x78, 0x9A, 0xBC), pages=None):
+        self.uid = bytes(uid)
+        self.level1 = bytes([PICC_CASCADE_TAG]) + self.uid[0:3]
+        self.level2 = self.uid[3:7]
+        self.pages = [bytearray(4) for i in range(self.PAGES)]
+        self.pages[0][:] = self.level1[1:4] + bytes([PICC_CASCADE_TAG ^ self.uid[0] ^ self.uid[1] ^ self.uid[2]])
+        self.pages[1][:] = self.level2
+        self.pages[2][0] = self.level2[0] ^ self.level2[1] ^ self.level2[2] ^ self.level2[3]
+        self.pages[3][:] = bytes([0xE1, 0x10, 0x12, 0x00])  # capability container
+        for number, data in (pages or {}).items():
+            self.pages[number][:] = bytes(data)
+        self.state = 'IDLE'
+        self.woken = False
+
+    def power_off(self):
+        self.state = 'IDLE'
+        self.woken = False
+
+    def back(self):
+        woken = self.woken
+        self.power_off()
+        if woken:
+            self.state = 'HALT'
+
+    def authenticate(self, mode, block, key, uid):
+        self.power_off()  # no Crypto1
+        return False
+
+    def user_data(self, first=4, size=16):
+        return b''.join(bytes(page) for page in self.pages[first:first + (size + 3) // 4])[:size]
+
+    def transceive(self, frame, last_bits):
+        if last_bits == 7 and len(frame) == 1:
+            if (frame[0] == PICC_REQIDL and self.state == 'IDLE') or \
+               (frame[0] == PICC_REQALL and self.state in ('IDLE', 'HALT')):
+                self.woken = self.state == 'HALT'
+                self.state = 'READY1'
+                return self.ATQA, 16
+            if self.state not in ('IDLE', 'HALT'):
+                self.back()
+            return None
+        if self.state in ('READY1', 'READY2'):
+            level, uid, sak = ((PICC_ANTICOLL1, self.level1, self.SAK_LEVEL1) if self.state == 'READY1'
+                               else (PICC_ANTICOLL2, self.level2, self.SAK))
+            if is_anticoll(frame, level):
+                return anticoll(frame, last_bits, uid)
+            if len(frame) == 9 and frame[0:2] == bytes([level, 0x70]) and check_crc(frame) and frame[2:6] == uid:
+                self.state = 'READY2' if self.state == 'READY1' else 'ACTIVE'
+                return bytes([sak]) + bytes(crc_a([sak])), 24
+            self.back()
+            return None
+        if self.state != 'ACTIVE':
+            return None
+        if not check_crc(frame):
+            self.power_off()
+            return None
+        if frame[0] == PICC_HALT:
+            self.state = 'HALT'
+            return None
+        if frame[0] == PICC_READ and len(frame) == 4:
+            page = frame[1]
+            if page >= self.PAGES:
+                return bytes([0x00]), 4
+            data = b''.join(bytes(self.pages[(page + i) % self.PAGES]) for i in range(4))  # rolls over
+            return data + bytes(crc_a(data)), 144
+        if frame[0] == PICC_UL_FAST_READ and len(frame) == 5:
+            first, last = frame[1], frame[2]
+            if first > last or last >= self.PAGES:
+                self.power_off()
+                return bytes([0x00]), 4
+            data = b''.join(bytes(page) for page in self.pages[first:last + 1])
+            return data + bytes(crc_a(data)), (len(data) + 2) * 8
+        if frame[0] == PICC_UL_WRITE and len(frame) == 8:
+            page = frame[1]
+            if page < 4 or page >= 40:  # UID, lock bytes, capability container and configuration
+                return bytes([0x00]), 4
+            self.pages[page][:] = frame[2:6]
+            return bytes([ACK]), 4
+        self.power_off()
+        return None
+
+
+class SimulatedRc522(Transport):
+    """RC522 register file with zero or more cards in the field"""
+
+    def __init__(self, *cards, response_time=0.0, timeout_time=0.0):
+        super(SimulatedRc522, self).__init__()
+        self.cards = list(cards)
+        self.response_time = response_time
+        self.timeout_time = timeout_time
+        self.regs = [0] * 64
+        self.fifo = bytearray()
+        self.pending = None  # (completion time, completion function) of the running command
+        self.pins = {}
+        self.reset()
+
+    def reset(self):
+        self.pending = None
+        self.regs = [0] * 64
+        self.regs[CommandReg] = 0x20
+        self.regs[TxControlReg] = 0x80
+        self.regs[VersionReg] = 0x92
+        self.regs[CollReg] = 0xA0  # ValuesAfterColl, CollPosNotValid
+        self.fifo = bytearray()
+        for card in self.cards:
+            card.power_off()
+
+    @property
+    def field_on(self):
+        return (self.regs[TxControlReg] & 0x03) != 0
+
+    @property
+    def irq_line(self):
+        """True while the IRQ pin is asserted"""
+        return bool((self.regs[ComIEnReg] & self.regs[ComIrqReg] & 0x7F) or
+                    (self.regs[DivlEnReg] & self.regs[DivIrqReg] & 0x14))
+
+    def present(self, card):
+        """put a card on the antenna"""
+        card.power_off()
+        self.cards.append(card)
+
+    def remove(self, card):
+        """take a card off the antenna"""
+        self.cards.remove(card)
+        card.power_off()
+
+    def _complete(self, delay, done):
+        if delay > 0:
+            self.pending = (time.perf_counter() + delay, done)
+        else:
+            done()
+
+    def _settle(self):
+        if self.pending is not None and time.perf_counter() >= self.pending[0]:
+            done, self.pending = self.pending[1], None
+            done()
+
+    def _write(self, address, value):
+        self._settle()
+        if address == FIFODataReg:
+            if len(self.fifo) < 64:
+                self.fifo.append(value & 0xFF)
+        elif address == FIFOLevelReg:
+            if value & 0x80:
+                self.fifo = bytearray()
+        elif address in (ComIrqReg, DivIrqReg):
+            if value & 0x80:
+                self.regs[address] |= value & 0x7F
+            else:
+                self.regs[address] &= ~value & 0x7F
+        elif address == ControlReg:
+            pass  # TStopNow/TStartNow, RxLastBits is read only
+        elif address == CollReg:
+            self.regs[CollReg] = (value & 0x80) | (self.regs[CollReg] & 0x7F)  # CollPos is read only
+        elif address == CommandReg:
+            self.pending = None  # a new command aborts the running one
+            self.regs[CommandReg] = value & 0x3F
+            self._command(value & 0x0F)
+        elif address == BitFramingReg:
+            self.regs[BitFramingReg] = value & 0x7F
+            if (value & 0x80) and (self.regs[CommandReg] & 0x0F) == PCD_TRANSCEIVE:
+                self._transceive()
+        elif address == TxControlReg:
+            was_on = self.field_on
+            self.regs[TxControlReg] = value
+            if was_on and not self.field_on:
+                for card in self.cards:
+                    card.power_off()
+        else:
+            self.regs[address] = value & 0xFF
+
+    def _read(self, address):
+        self._settle()
+        if address == FIFODataReg:
+            if not self.fifo:
+                return 0
+            value = self.fifo[0]
+            del self.fifo[0]
+            return value
+        if address == FIFOLevelReg:
+            return len(self.fifo)
+        return self.regs[address]
+
+    def pin_mode(self, pin, mode):
+        pass
+
+    def digital_write(self, pin, value):
+        self.pins[pin] = value
+
+    def irq_setup(self, pin):
+        self.irq_pin = pin
+
+    def irq_wait(self, timeout):
+        self._settle()
+        if not self.irq_line:
+            if self.pending is not None:
+                timeout = min(max(self.pending[0] - time.perf_counter(), 0), timeout)
+            time.sleep(timeout)
+            self._settle()
+        return self.irq_line
+
+    def _command(self, command):
+        if command == PCD_RESETPHASE:
+            self.reset()
+        elif command == PCD_CALCCRC:
+            low, high = crc_a(self.fifo)
+            self.fifo = bytearray()
+            self.regs[CRCResultRegL] = low
+            self.regs[CRCResultRegM] = high
+            self.regs[DivIrqReg] |= 0x04
+        elif command == PCD_TRANSMIT:
+            frame, self.fifo = bytes(self.fifo), bytearray()
+            last_bits = self.regs[BitFramingReg] & 0x07
+            if self.field_on:
+                for card in self.cards:
+                    card.transceive(frame, last_bits)
+            self.regs[ComIrqReg] |= 0x50  # TxIRq, IdleIRq
+            self.regs[CommandReg] = PCD_IDLE
+        elif command == PCD_AUTHENT:
+            frame, self.fifo = bytes(self.fifo), bytearray()
+            card = self._active_card()
+            if self.field_on and card is not None and len(frame) == 12 \
+                    and card.authenticate(frame[0], frame[1], frame[2:8], frame[8:12]):
+                self._complete(self.response_time, self._auth_done)
+            else:
+                self._complete(self.timeout_time, self._timeout)
+
+    def _auth_done(self):
+        self.regs[Status2Reg] |= 0x08
+        self.regs[ComIrqReg] |= 0x10
+        self.regs[CommandReg] = PCD_IDLE
+
+    def _timeout(self):
+        self.regs[ComIrqReg] |= 0x01  # TimerIRq
+
+    def _active_card(self):
+        for card in self.cards:
+            if card.state == 'ACTIVE':
+                return card
+        return None
+
+    def _transceive(self):
+        frame, self.fifo = bytes(self.fifo), bytearray()
+        last_bits = self.regs[BitFramingReg] & 0x07
+        self.regs[ErrorReg] = 0
+        answers = []
+        if self.field_on:
+            for card in self.cards:
+                answer = card.transceive(frame, last_bits)
+                if answer is not None:
+                    answers.append(answer)
+        self.regs[ComIrqReg] |= 0x40  # TxIRq
+        if not answers:
+            self._complete(self.timeout_time, self._timeout)
+            return
+        rx_align = (self.regs[BitFramingReg] >> 4) & 0x07  # the first bit received goes to bit rx_align
+        collision = None
+        coll = 0x20  # CollPosNotValid
+        if len(answers) == 1 and not rx_align:
+            fifo, bits = answers[0]
+        else:
+            # the answers add up on the air, the first bit where they differ is a collision
+            streams = [to_bits(data, bits) for data, bits in answers]
+            received = streams[0]
+            for i in range(max(len(stream) for stream in streams)):
+                if any(i >= len(stream) or i >= len(received) or stream[i] != received[i] for stream in streams):
+                    collision = i
+                    break
+            received = [0] * rx_align + received
+            if collision is not None:
+                position = rx_align + collision + 1  # counted from bit 0 of the first FIFO byte
+                coll = position & 0x1F if position <= 32 else 0x20
+                if not self.regs[CollReg] & 0x80:  # ValuesAfterColl clear: bits from the collision on read 0
+                    received = received[:position - 1] + [0] * (len(received) - position + 1)
+            fifo, bits = from_bits(received), len(received)
+
+        def done():
+            if collision is not None:
+                self.regs[ErrorReg] |= 0x08  # CollErr
+            self.regs[CollReg] = (self.regs[CollReg] & 0x80) | coll
+            self.fifo = bytearray(fifo)
+            self.regs[ControlReg] = bits % 8
+            self.regs[ComIrqReg] |= 0x30  # RxIRq, IdleIRq
+        self._complete(self.response_time, done)
@@ -0,0 +1,266 @@
+# RC522 register transports
+#
+# Description: The Rc522_api driver talks to the reader through a transport object
+#              instead of owning spidev/wiringpi directly, so the same driver code
+#              can run against the real HAT, record a trace of every register
+#              access, or replay a recorded trace on a machine without SPI.
+#
+# Trace format: one operation per line, "<seconds> <op> <arg> <value>" in hex, where
+#               op is R (register read), W (register write), M (pin mode) or
+#               D (digital write). Lines starting with '#' are comments.
+
+import threading
+import time
+
+
+class ReplayError(Exception):
+    """the driver diverged from the recorded trace"""
+
+
+class Transport(object):
+    """base transport, counts register accesses and bus transfers (SPI ioctls) so callers
+    can profile the driver. Subclasses either override the public methods or implement
+    _read/_write for a single register access."""
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.transfers = 0
+
+    @property
+    def ops(self):
+        return self.reads + self.writes
+
+    def reset_counters(self):
+        self.reads = 0
+        self.writes = 0
+        self.transfers = 0
+
+    def write_reg(self, address, value):
+        self.transfers += 1
+        self.writes += 1
+        self._write(address, value)
+
+    def read_reg(self, address):
+        self.transfers += 1
+        self.reads += 1
+        return self._read(address)
+
+    def write_burst(self, address, values):
+        """write several values to one register (FIFO load) in a single transfer"""
+        self.transfers += 1
+        self.writes += len(values)
+        for value in values:
+            self._write(address, value)
+
+    def read_regs(self, addresses):
+        """read several registers (repeats allowed, e.g. FIFODataReg) in a single transfer"""
+        self.transfers += 1
+        self.reads += len(addresses)
+        return [self._read(address) for address in addresses]
+
+    def _write(self, address, value):
+        raise NotImplementedError
+
+    def _read(self, address):
+        raise NotImplementedError
+
+    def pin_mode(self, pin, mode):
+        pass
+
+    def digital_write(self, pin, value):
+        pass
+
+    def irq_setup(self, pin):
+        raise NotImplementedError('%s has no IRQ line' % type(self).__name__)
+
+    def irq_arm(self):
+        """forget earlier IRQ edges, called before starting a command"""
+        pass
+
+    def irq_wait(self, timeout):
+        """block until the IRQ pin fires or timeout seconds pass, returns True on an edge"""
+        return False
+
+    def close(self):
+        pass
+
+
+class SpiTransport(Transport):
+    """RC522 on a Raspberry Pi SPI bus, GPIO via wiringpi"""
+
+    def __init__(self, bus=0, dev=0, speed=1000000):
+        super(SpiTransport, self).__init__()
+        import spidev
+        import wiringpi
+        self.wiringpi = wiringpi
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, dev)
+        self.spi.max_speed_hz = speed
+        self.spi.mode = 0b00
+        self.spi.xfer([1000000, 10, 8])
+
+        print('spi init')
+        wiringpi.wiringPiSetup()
+
+    # every access is one full-duplex xfer2 (a single ioctl): the first byte is the address
+    # (the lowest 6 bits are the actual address, MSB:1 for read), reads clock out one address
+    # per register and a trailing 0 while the answers come back shifted by one byte
+    def write_reg(self, address, value):
+        self.transfers += 1
+        self.writes += 1
+        self.spi.xfer2([(address << 1) & 0x7E, value])
+
+    def read_reg(self, address):
+        self.transfers += 1
+        self.reads += 1
+        return self.spi.xfer2([((address << 1) & 0x7E) | 0x80, 0])[1]
+
+    def write_burst(self, address, values):
+        self.transfers += 1
+        self.writes += len(values)
+        self.spi.xfer2([(address << 1) & 0x7E] + list(values))
+
+    def read_regs(self, addresses):
+        self.transfers += 1
+        self.reads += len(addresses)
+        return self.spi.xfer2([((address << 1) & 0x7E) | 0x80 for address in addresses] + [0])[1:]
+
+    def pin_mode(self, pin, mode):
+        self.wiringpi.pinMode(pin, mode)
+
+    def digital_write(self, pin, value):
+        self.wiringpi.digitalWrite(pin, value)
+
+    def irq_setup(self, pin):
+        """pin uses physical (BOARD) numbering like the button pins in spotify.py,
+        the RC522 IRQ output is active low (IRqInv in ComIEnReg)"""
+        import RPi.GPIO as GPIO
+        self.irq_event = threading.Event()
+        GPIO.setmode(GPIO.BOARD)
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(pin, GPIO.FALLING, callback=lambda channel: self.irq_event.set())
+
+    def irq_arm(self):
+        self.irq_event.clear()
+
+    def irq_wait(self, timeout):
+        return self.irq_event.wait(timeout)
+
+    def close(self):
+        self.spi.close()
+
+
+class CaptureTransport(Transport):
+    """pass-through transport that logs every operation of the wrapped transport to a trace file"""
+
+    def __init__(self, inner, path):
+        super(CaptureTransport, self).__init__()
+        self.inner = inner
+        self.trace = open(path, 'w')
+        self.trace.write('# rc522 trace\n')
+        self.start = time.perf_counter()
+
+    def _log(self, op, arg, value):
+        self.trace.write('%.6f %s %02x %02x\n' % (time.perf_counter() - self.start, op, arg, value))
+
+    def write_reg(self, address, value):
+        self.transfers += 1
+        self.writes += 1
+        self.inner.write_reg(address, value)
+        self._log('W', address, value)
+
+    def read_reg(self, address):
+        self.transfers += 1
+        self.reads += 1
+        value = self.inner.read_reg(address)
+        self._log('R', address, value)
+        return value
+
+    def write_burst(self, address, values):
+        self.transfers += 1
+        self.writes += len(values)
+        self.inner.write_burst(address, values)
+        for value in values:
+            self._log('W', address, value)
+
+    def read_regs(self, addresses):
+        self.transfers += 1
+        self.reads += len(addresses)
+        values = self.inner.read_regs(addresses)
+        for address, value in zip(addresses, values):
+            self._log('R', address, value)
+        return values
+
+    def pin_mode(self, pin, mode):
+        self.inner.pin_mode(pin, mode)
+        self._log('M', pin, mode)
+
+    def digital_write(self, pin, value):
+        self.inner.digital_write(pin, value)
+        self._log('D', pin, value)
+
+    def irq_setup(self, pin):
+        self.inner.irq_setup(pin)
+        self.trace.write('# irq pin %d\n' % pin)
+
+    def irq_arm(self):
+        self.inner.irq_arm()
+
+    def irq_wait(self, timeout):
+        return self.inner.irq_wait(timeout)
+
+    def close(self):
+        self.trace.close()
+        self.inner.close()
+
+
+class ReplayTransport(Transport):
+    """plays a captured trace back to the driver, raising ReplayError as soon as the driver diverges"""
+
+    def __init__(self, path):
+        super(ReplayTransport, self).__init__()
+        self.trace = []
+        self.irq_pin = None  # IRQ pin the trace was captured with, the driver needs the same
+        with open(path) as f:
+            for line in f:
+                if line.startswith('# irq pin '):
+                    self.irq_pin = int(line.split()[3])
+                if not line.strip() or line.startswith('#'):
+                    continue
+                stamp, op, arg, value = line.split()
+                self.trace.append((float(stamp), op, int(arg, 16), int(value, 16)))
+        self.position = 0
+
+    @property
+    def done(self):
+        return self.position >= len(self.trace)
+
+    def _next(self, op, arg, value=None):
+        if self.done:
+            raise ReplayError('trace exhausted at %s %02x' % (op, arg))
+        stamp, rec_op, rec_arg, rec_value = self.trace[self.position]
+        if rec_op != op or rec_arg != arg or (value is not None and rec_value != value):
+            raise ReplayError('entry %d: expected %s %02x %02x, got %s %02x %s'
+                              % (self.position, rec_op, rec_arg, rec_value, op, arg,
+                                 '--' if value is None else '%02x' % value))
+        self.position += 1
+        return rec_value
+
+    def _write(self, address, value):
+        self._next('W', address, value)
+
+    def _read(self, address):
+        return self._next('R', address)
+
+    def pin_mode(self, pin, mode):
+        self._next('M', pin, mode)
+
+    def digital_write(self, pin, value):
+        self._next('D', pin, value)
+
+    def irq_setup(self, pin):
+        pass
+
+    def irq_wait(self, timeout):
+        return True  # the recorded register values tell the driver what happened
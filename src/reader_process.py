@@ -0,0 +1,370 @@
+# RFID reader process
+#
+# Description: Runs the RC522 polling loop in a process of its own, so the SPI
+#              timing in pcd_com_mf522 no longer shares a GIL with spotipy's HTTP and
+#              JSON work and the RPi.GPIO callback thread. The reader process can raise
+#              its scheduling priority and be pinned to a core. It talks to the
+#              controller (the jukebox) over its stdin/stdout pipes, one line per
+#              message:
+#
+#                reader -> controller   A <uid> <data> <polled>    card arrived
+#                                       R <uid>                    card removed
+#                                       S <polls> <transfers> <ops>  counters, every STATS_INTERVAL
+#                controller -> reader   W                          wake, poll fast
+#
+#              uid and data are hex, polled is the time.monotonic() the poll that
+#              found the card started. ReaderProcess is the controller's side: it
+#              starts the reader and starts it again, with a growing delay, whenever
+#              it dies. The reader exits as soon as its stdin is closed, so a
+#              controller that dies (and is restarted by systemd) never leaves a
+#              second reader polling the same RC522.
+#
+# Usage: $ > python3 reader_process.py serve [BUS DEV RESET-PIN [FAST-MS SLOW-MS [PRIORITY [CPU]]]]
+#        $ > python3 reader_process.py load [SECONDS] [THREADS]
+
+import contextlib
+import io
+import json
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+
+import module
+import poll_scheduler
+
+STATS_INTERVAL = 1     # seconds between counter messages
+RESTART_DELAY = 0.5    # seconds before the first restart of a reader that died
+RESTART_MAX = 30       # longest delay between restarts, doubled from RESTART_DELAY
+RESTART_RESET = 60     # seconds a reader has to run for the delay to start over
+LOAD_PERIOD = 0.4      # seconds between simulated cards in the load benchmark
+LOAD_THREADS = 3       # threads of synthetic controller work
+READER_NICE = -10      # nice increment of a reader that may not use SCHED_FIFO
+
+SCRIPT = os.path.abspath(__file__)
+
+
+def set_priority(priority=None, cpu=None):
+    """SCHED_FIFO at priority (1-99) or, where that is not allowed, nice READER_NICE,
+    and pin the process to cpu. Both need root, a reader that may not is only warned
+    about and carries on at normal priority"""
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (OSError, AttributeError) as e:
+            try:
+                os.nice(READER_NICE)
+            except OSError:
+                print("Warning: reader priority not raised: " + str(e), file=sys.stderr)
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (OSError, AttributeError) as e:
+            print("Warning: reader not pinned to cpu %d: %s" % (cpu, e), file=sys.stderr)
+
+
+def channel():
+    """the protocol pipe: our stdout, with print() (the driver's 'OK', 'spi init')
+    moved to stderr so it can not corrupt a message"""
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb', buffering=0)
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return out
+
+
+def serve(rc, poller, out, control):
+    """the reader loop: poll rc at the poller's pace, write events and counters to
+    out, wake up on a W from the control fd. Returns when control is closed"""
+    transport = rc.transport
+    stats = time.monotonic()
+    while True:
+        polled = time.monotonic()
+        events = rc.poll(rc.block_num, poller.antenna_off())
+        poller.polled(bool(events))
+        lines = []
+        for event, uid, data in events:
+            if event == module.CARD_REMOVED:
+                lines.append("R %s\n" % uid.hex())
+            else:
+                lines.append("A %s %s %.6f\n" % (uid.hex(), bytes(data).hex(), polled))
+        if time.monotonic() - stats >= STATS_INTERVAL:
+            stats = time.monotonic()
+            lines.append("S %d %d %d\n" % (poller.polls, transport.transfers, transport.ops))
+        if lines:
+            try:
+                out.write("".join(lines).encode())
+            except BrokenPipeError:
+                return
+        # sleeping on the control pipe, a wake cuts a slow interval short
+        timeout = max(0, poller.interval() - (time.monotonic() - polled))
+        if select.select([control], [], [], timeout)[0]:
+            message = os.read(control, 64)
+            if not message:
+                return
+            if b'W' in message:
+                poller.wake()
+
+
+def parse(line):
+    """one reader message as (event, uid, data, polled) for A and R, or
+    ('S', polls, transfers, ops); None when it is not one"""
+    fields = line.split()
+    try:
+        if fields[0] == 'A' and len(fields) == 4:
+            return module.CARD_ARRIVED, bytes.fromhex(fields[1]), bytes.fromhex(fields[2]), float(fields[3])
+        if fields[0] == 'R' and len(fields) == 2:
+            return module.CARD_REMOVED, bytes.fromhex(fields[1]), None, None
+        if fields[0] == 'S' and len(fields) == 4:
+            return 'S', int(fields[1]), int(fields[2]), int(fields[3])
+    except (ValueError, IndexError):
+        pass
+    return None
+
+
+class Counters(object):
+    """the transport counters of the reader, as last reported by it"""
+
+    def __init__(self):
+        self.polls = 0
+        self.transfers = 0
+        self.ops = 0
+
+
+class ReaderProcess(object):
+    """stands in for the Rc522_api of a jukebox.Reader, the polling happens in the
+    reader process and the jukebox only receives its events"""
+
+    def __init__(self, bus=0, dev=0, reset_pin=25, fast=poll_scheduler.FAST_INTERVAL,
+                 slow=poll_scheduler.SLOW_INTERVAL, priority=None, cpu=None, args=None):
+        """priority: SCHED_FIFO priority of the reader, cpu: core it is pinned to
+        args: serve arguments replacing the reader settings, e.g. for the simulator"""
+        if args is None:
+            args = [bus, dev, reset_pin, int(fast * 1000), int(slow * 1000)]
+            if priority is not None or cpu is not None:
+                args.append(priority if priority is not None else '-')
+            if cpu is not None:
+                args.append(cpu)
+        self.args = [str(arg) for arg in args]
+        self.proc = None
+        self.buffer = b''
+        self.transport = Counters()
+        self.started = None
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+        self.restart_at = 0
+
+    def start(self):
+        self.proc = subprocess.Popen([sys.executable, SCRIPT, 'serve'] + self.args,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        self.buffer = b''
+        self.started = time.monotonic()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def receive(self):
+        """the events that have arrived, as (event, uid, data, polled) tuples. Notices
+        a reader that died, supervise() starts it again"""
+        if self.proc is None:
+            return []
+        try:
+            chunk = os.read(self.fileno(), 65536)
+        except BlockingIOError:
+            return []
+        if not chunk:
+            self._died()
+            return []
+        lines = (self.buffer + chunk).split(b'\n')
+        self.buffer = lines.pop()
+        events = []
+        for line in lines:
+            message = parse(line.decode(errors='replace'))
+            if message is None:
+                print("Error: reader message not understood: %r" % line)
+            elif message[0] == 'S':
+                self.transport.polls, self.transport.transfers, self.transport.ops = message[1:]
+            else:
+                events.append(message)
+        return events
+
+    def _died(self):
+        code = self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc = None
+        if time.monotonic() - self.started >= RESTART_RESET:
+            self.delay = RESTART_DELAY
+        print("Error: reader process exited with code %d, restarting in %.1f s" % (code, self.delay))
+        self.restart_at = time.monotonic() + self.delay
+        self.delay = min(self.delay * 2, RESTART_MAX)
+
+    def supervise(self):
+        """start the reader if it is not running and its restart delay is over,
+        returns True when it is running"""
+        if self.proc is not None and self.proc.poll() is not None:
+            self._died()
+        if self.proc is None and time.monotonic() >= self.restart_at:
+            if self.started is not None:
+                self.restarts += 1
+            self.start()
+        return self.proc is not None
+
+    def wake(self):
+        """poll fast, a button was pressed"""
+        if self.alive():
+            try:
+                self.proc.stdin.write(b'W\n')
+            except BrokenPipeError:
+                pass
+
+    def close(self, wait=True):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()  # the reader exits on its own
+        if wait:
+            try:
+                self.proc.wait(1)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+
+
+def sim_cards(sim, start, period, cards):
+    """present card i (UID 00 00 00 i) for half a period from start + i * period"""
+    import rc522_sim
+    for i in range(cards):
+        card = rc522_sim.MifareS50Card(uid=(0, 0, i >> 8, i & 0xFF), blocks={8: range(16)})
+        time.sleep(max(0, start + i * period - time.monotonic()))
+        sim.present(card)
+        time.sleep(max(0, start + (i + 0.5) * period - time.monotonic()))
+        sim.remove(card)
+
+
+def sim_reader(start, period, cards):
+    """Rc522_api on the simulator, fed cards by a thread as in sim_cards"""
+    import rc522_sim
+    sim = rc522_sim.SimulatedRc522(timeout_time=0.015)
+    rc = module.Rc522_api(sim)
+    rc.init()
+    threading.Thread(target=sim_cards, args=(sim, start, period, cards), daemon=True).start()
+    return rc
+
+
+def controller_load(stop):
+    """what the controller does between taps, at its busiest: JSON parsing of Web API
+    sized responses"""
+    album = {"name": "Album", "artists": [{"name": "Artist", "id": "0" * 22}] * 2,
+             "tracks": {"items": [{"name": "Track %d" % i, "id": "%022d" % i, "duration_ms": 200000,
+                                   "available_markets": ["DE", "FR", "GB", "US"] * 20} for i in range(20)]}}
+    text = json.dumps({"albums": [album] * 20})
+    while not stop.is_set():
+        json.loads(text)
+
+
+def load(seconds=10, threads=LOAD_THREADS, in_process=False, priority=None):
+    """cards placed every LOAD_PERIOD on a simulated reader while the controller runs
+    threads of JSON work, returns (cards placed, cards missed, latencies in seconds)
+    from placing a card to its event reaching the controller"""
+    cards = int(seconds / LOAD_PERIOD)
+    start = time.monotonic() + 2.0  # after the reader's rc.init(), which sleeps 1 s
+    fast = poll_scheduler.FAST_INTERVAL
+    if in_process:
+        # the reader on a thread of the controller, as jukebox.reader_task polls it
+        out_r, out_w = os.pipe()
+        control_r, control_w = os.pipe()
+        with contextlib.redirect_stdout(io.StringIO()):  # the driver's 'OK'
+            rc = sim_reader(start, LOAD_PERIOD, cards)
+        poller = poll_scheduler.PollScheduler(fast, fast)
+        threading.Thread(target=serve, args=(rc, poller, os.fdopen(out_w, 'wb', buffering=0), control_r),
+                         daemon=True).start()
+        source = os.fdopen(out_r, 'rb')
+    else:
+        reader = ReaderProcess(args=['sim', '%.6f' % start, LOAD_PERIOD, cards, int(fast * 1000)] +
+                               ([priority] if priority is not None else []))
+        reader.start()
+        source = reader.proc.stdout
+        os.set_blocking(source.fileno(), True)
+    stop = threading.Event()
+    workers = [threading.Thread(target=controller_load, args=(stop,), daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    latencies = {}
+    end = start + cards * LOAD_PERIOD + 0.5
+    try:
+        while time.monotonic() < end:
+            if not select.select([source], [], [], 0.05)[0]:
+                continue
+            line = source.readline()
+            received = time.monotonic()
+            message = parse(line.decode())
+            if message is not None and message[0] == module.CARD_ARRIVED:
+                i = int.from_bytes(message[1], 'big')
+                latencies.setdefault(i, received - (start + i * LOAD_PERIOD))
+    finally:
+        stop.set()
+        if in_process:
+            os.close(control_w)
+        else:
+            reader.close()
+    return cards, cards - len(latencies), sorted(latencies.values())
+
+
+def serve_main(args):
+    """serve [BUS DEV RESET-PIN [FAST-MS SLOW-MS [PRIORITY|- [CPU]]]]
+    or serve sim START PERIOD CARDS FAST-MS [PRIORITY] for load()"""
+    out = channel()
+    if args and args[0] == 'sim':
+        fast = slow = int(args[4]) / 1000
+        extra = args[5:]
+    else:
+        bus, dev, reset_pin = (int(arg) for arg in (args[0:3] or (0, 0, 25)))
+        fast = int(args[3]) / 1000 if len(args) > 3 else poll_scheduler.FAST_INTERVAL
+        slow = int(args[4]) / 1000 if len(args) > 4 else poll_scheduler.SLOW_INTERVAL
+        extra = args[5:]
+    set_priority(int(extra[0]) if extra and extra[0] != '-' else None,
+                 int(extra[1]) if len(extra) > 1 else None)
+    if args and args[0] == 'sim':
+        rc = sim_reader(float(args[1]), float(args[2]), int(args[3]))
+    else:
+        rc = module.Rc522_api(bus=bus, dev=dev, reset_pin=reset_pin, led_pin=None, buzzer_pin=None)
+        rc.init()
+    try:
+        serve(rc, poll_scheduler.PollScheduler(fast, slow), out, sys.stdin.fileno())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == 'serve':
+        return serve_main(argv[2:])
+    if len(argv) > 1 and argv[1] == 'load':
+        seconds = float(argv[2]) if len(argv) > 2 else 10
+        threads = int(argv[3]) if len(argv) > 3 else LOAD_THREADS
+        print('%d thread(s) of controller JSON work, a card every %.0f ms' % (threads, LOAD_PERIOD * 1000))
+        print('reader                 cards  missed   latency mean / p95 / max')
+        for label, in_process, priority in (('controller thread', True, None), ('own process', False, None),
+                                            ('own process, FIFO 50', False, 50)):
+            cards, missed, latencies = load(seconds, threads, in_process, priority)
+            if latencies:
+                print('%-20s %7d %7d   %7.1f / %.1f / %.1f ms' % (
+                    label, cards, missed, sum(latencies) / len(latencies) * 1000,
+                    latencies[int(len(latencies) * 0.95)] * 1000, latencies[-1] * 1000))
+            else:
+                print('%-20s %7d %7d   no card seen' % (label, cards, missed))
+        return 0
+    print('Usage: python3 reader_process.py serve [BUS DEV RESET-PIN [FAST-MS SLOW-MS [PRIORITY [CPU]]]]')
+    print('       python3 reader_process.py load [SECONDS] [THREADS]')
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,83 @@
+# Spotify token handling
+#
+# Description: Keeps the OAuth access token in memory and renews it ahead of expiry,
+#              so no Web API call has to stop for a token request. TokenManager is
+#              given to spotipy.Spotify as its auth manager: requests read the
+#              current token without touching the cache file, refresh_if_due() is
+#              called from the background to renew it REFRESH_MARGIN seconds early,
+#              and when a refresh is needed anyway the callers that hit it at the
+#              same time share a single token request. The token cache file is
+#              replaced atomically, never left half written.
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from spotipy.cache_handler import CacheFileHandler
+
+REFRESH_MARGIN = 300  # seconds before expiry the background refresh renews the token
+EXPIRY_SLACK = 60     # a token closer than this to expiry is not used for a request
+
+
+class AtomicCacheFileHandler(CacheFileHandler):
+    """token cache file written to a temporary file and renamed into place"""
+
+    def save_token_to_cache(self, token_info):
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.token-', suffix='.tmp')  # mode 0600
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps(token_info, cls=self.encoder_cls))
+                os.replace(tmp, self.cache_path)
+            except OSError:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            print("Error: token not cached: " + str(e))
+
+
+class TokenManager(object):
+    def __init__(self, oauth, margin=REFRESH_MARGIN, clock=time.time):
+        """oauth: spotipy SpotifyOAuth, clock: seconds since the epoch"""
+        self.oauth = oauth
+        self.margin = margin
+        self.clock = clock
+        self.token_info = None
+        self.expires_at = 0
+        self.refreshes = 0
+        self.refresh_lock = threading.Lock()
+
+    def get_access_token(self, as_dict=False):
+        """the current access token, renewed first only if it is about to expire"""
+        if self.token_info is None or self.expires_at - self.clock() < EXPIRY_SLACK:
+            self._refresh(EXPIRY_SLACK)
+        return self.token_info if as_dict else self.token_info["access_token"]
+
+    def refresh_due(self):
+        return self.token_info is None or self.expires_at - self.clock() <= self.margin
+
+    def refresh_if_due(self):
+        """renew the token when it is within margin seconds of expiry"""
+        self._refresh(self.margin)
+
+    def _refresh(self, within):
+        with self.refresh_lock:
+            # whoever held the lock before us may already have renewed it
+            if self.token_info is not None and self.expires_at - self.clock() > within:
+                return
+            if self.token_info is None:
+                token_info = self.oauth.cache_handler.get_cached_token()
+                if token_info is None:
+                    self.oauth.get_access_token(as_dict=False)  # interactive login
+                    token_info = self.oauth.cache_handler.get_cached_token()
+                self.token_info, self.expires_at = token_info, token_info["expires_at"]
+                if self.expires_at - self.clock() > within:
+                    return
+            start = self.clock()
+            token_info = self.oauth.refresh_access_token(self.token_info["refresh_token"])
+            self.refreshes += 1
+            self.token_info, self.expires_at = token_info, start + token_info["expires_in"]
+            print("Spotify token renewed, valid for %d s" % token_info["expires_in"])
@@ -0,0 +1,174 @@
+# Spotify HTTP plumbing
+#
+# Description: One keep-alive connection pool shared by every Spotify Web API call,
+#              and a caller that gives each call a time budget. Within the budget a
+#              call is retried on 429 (waiting out Retry-After), 5xx, timeouts and
+#              dropped connections with jittered exponential backoff; every request
+#              it makes is cut off when the budget runs out. A circuit breaker opens
+#              after repeated outage errors so calls fail fast while the API is down
+#              and lets a single probe through once it has cooled off.
+
+import random
+import threading
+import time
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+POOL_SIZE = 4             # connections kept alive, one per Spotify worker thread
+TIMEOUTS = (3.05, 5)      # (connect, read) seconds for a single request
+RETRY_ATTEMPTS = 4        # requests per call, including the first
+RETRY_BASE = 0.25         # seconds, doubled per attempt before jitter
+RETRY_MAX = 4             # longest single backoff in seconds
+BREAKER_THRESHOLD = 5     # consecutive outage errors that open the breaker
+BREAKER_RESET = 30        # seconds the breaker stays open before a probe
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    """the Spotify API failed repeatedly and calls are refused until the breaker resets"""
+
+
+class SpotifySession(requests.Session):
+    """keep-alive session whose request timeouts are capped by the calling thread's budget"""
+
+    def __init__(self, pool_size=POOL_SIZE):
+        super(SpotifySession, self).__init__()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.local = threading.local()
+
+    def request(self, method, url, *args, **kwargs):
+        deadline = getattr(self.local, 'deadline', None)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout('time budget used up before %s %s' % (method, url))
+            timeout = kwargs.get('timeout')
+            connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+            kwargs['timeout'] = (min(connect or remaining, remaining), min(read or remaining, remaining))
+        return super(SpotifySession, self).request(method, url, *args, **kwargs)
+
+
+class CircuitBreaker(object):
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_after=BREAKER_RESET, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """True if a request may go out; once cooled off, lets one probe through"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or self.clock() - self.opened_at < self.reset_after:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None or self.probing:
+                    print("Spotify API unavailable, failing fast for %d s" % self.reset_after)
+                self.opened_at = self.clock()
+                self.probing = False
+
+
+class SpotifyCaller(object):
+    def __init__(self, session=None, breaker=None, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE,
+                 max_delay=RETRY_MAX, clock=time.monotonic, sleep=time.sleep):
+        """session: the SpotifySession the spotipy client uses (budgets are not enforced
+        per request without it)"""
+        self.session = session
+        self.breaker = breaker if breaker is not None else CircuitBreaker(clock=clock)
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.retries = 0
+
+    def call(self, budget, method, *args, **kwargs):
+        """method(*args, **kwargs) within budget seconds, retrying transient errors"""
+        with metrics.stage('spotify_' + getattr(method, '__name__', 'call')):
+            try:
+                return self._call(budget, method, *args, **kwargs)
+            except CircuitOpenError:
+                metrics.count('spotify_fail_fast')
+                raise
+            except Exception:
+                metrics.count('spotify_errors')
+                raise
+
+    def _call(self, budget, method, *args, **kwargs):
+        deadline = self.clock() + budget
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError("Spotify API unavailable, not calling %s" % getattr(method, '__name__', method))
+            if self.session is not None:
+                self.session.local.deadline = deadline
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if self.is_outage(e):
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()  # the API answered, even if only to slow us down
+                attempt += 1
+                if delay is None or attempt >= self.attempts or self.breaker.is_open or \
+                        self.clock() + delay >= deadline:
+                    raise
+                print("Retrying %s in %.2f s: %s" % (getattr(method, '__name__', method), delay, e))
+                self.retries += 1
+                metrics.count('spotify_retries')
+                self.sleep(delay)
+            else:
+                self.breaker.success()
+                return result
+            finally:
+                if self.session is not None:
+                    self.session.local.deadline = None
+
+    @staticmethod
+    def is_outage(e):
+        if isinstance(e, spotipy.SpotifyException):
+            return e.http_status in RETRY_STATUSES and e.http_status != 429
+        return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    def retry_delay(self, e, attempt):
+        """seconds to wait before retrying after e, None if e is not worth a retry"""
+        if isinstance(e, spotipy.SpotifyException):
+            if e.http_status not in RETRY_STATUSES:
+                return None
+            retry_after = (e.headers or {}).get('Retry-After')
+            if retry_after is not None:
+                try:
+                    return float(retry_after) + random.random() * self.base_delay
+                except ValueError:
+                    pass
+        elif not isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return None
+        return random.random() * min(self.max_delay, self.base_delay * 2 ** attempt)
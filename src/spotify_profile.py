@@ -0,0 +1,206 @@
+# Spotify tap-to-audio profiler
+#
+# Description: Plays albums through PlayerStateMachine against the fake Spotify Web
+#              API and reports, per tap, every HTTP call made and the time from the
+#              tap until the server started audio. The original three round trip
+#              sequence (transfer, start, current_playback) is run alongside for
+#              comparison. The faults mode runs volume calls through injected 429s,
+#              5xx errors, hung responses and an outage, showing the retries made,
+#              the time each call took and when the circuit breaker fails fast.
+#              The token mode idles for an hour on an advanceable clock and shows
+#              which requests the next tap makes with a lazily refreshed token and
+#              with one renewed in the background, and that concurrent callers of an
+#              expired token share one refresh.
+#
+# Usage: $ > python3 spotify_profile.py tap [TAPS] [LATENCY-MS]
+#        $ > python3 spotify_profile.py faults
+#        $ > python3 spotify_profile.py token [LATENCY-MS]
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from spotipy.oauth2 import SpotifyOAuth
+
+import fake_spotify
+import jukebox
+import player as player_module
+import spotify_auth
+import spotify_http
+from player import PlayerStateMachine
+
+DEVICE_ID = 'jukebox'
+ALBUM_ID = '1DFixLWuPkv3KT3TnV35m3'
+SCOPE = 'user-read-playback-state user-modify-playback-state'
+
+
+class FakeClock(object):
+    """wall clock that only moves when advanced"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def legacy_play(player, id, resume):
+    """play_music as it was: always transfer, start, then fetch the volume"""
+    player.sp.transfer_playback(device_id=player.device_id, force_play=resume)
+    player.sp.start_playback(device_id=player.device_id, context_uri="spotify:album:" + str(id))
+    player.sp.current_playback(market=None, additional_types=None)
+
+
+def profile_taps(play, taps, latency):
+    """returns [(tap-to-audio seconds, [(method, path, seconds, status), ...]), ...]"""
+    fake = fake_spotify.FakeSpotify(devices=(DEVICE_ID,), latency=latency)
+    session = fake_spotify.TimedSession()
+    PlayerStateMachine._instances.clear()
+    player = PlayerStateMachine(DEVICE_ID, sp=fake.client(requests_session=session), session=session)
+    player.refresh_playback()  # the jukebox keeps the cache filled in the background
+    results = []
+    try:
+        for tap in range(taps):
+            if tap == taps - 1:
+                fake.active_device = None  # the device went idle, exercise the fallback
+            del session.calls[:]
+            start = time.monotonic()
+            play(player, ALBUM_ID, False)
+            played = fake.played[-1][0] if fake.played and fake.played[-1][0] >= start else None
+            results.append((played - start if played else None, list(session.calls)))
+    finally:
+        fake.close()
+    return results
+
+
+def report(label, results):
+    print(label)
+    for n, (audio, calls) in enumerate(results):
+        print('  tap %d: %s to audio, %d call(s)' % (
+            n, '%6.1f ms' % (audio * 1000) if audio is not None else '   none', len(calls)))
+        for method, path, seconds, status in calls:
+            print('      %-4s %-22s %3s %6.1f ms' % (method, path, status, seconds * 1000))
+    audio = [r[0] for r in results if r[0] is not None]
+    calls = sum(len(r[1]) for r in results)
+    print('  mean %.1f ms to audio, %.1f calls per tap' % (
+        sum(audio) / len(audio) * 1000 if audio else 0, calls / len(results)))
+
+
+def profile_faults():
+    """returns [(scenario, ok, seconds, requests seen by the server), ...]"""
+    fake = fake_spotify.FakeSpotify(devices=(DEVICE_ID,))
+    fake.active_device = DEVICE_ID
+    session = fake_spotify.TimedSession()
+    PlayerStateMachine._instances.clear()
+    player = PlayerStateMachine(DEVICE_ID, sp=fake.client(requests_session=session), session=session)
+    player.sp.requests_timeout = (0.5, 0.5)
+    player.api.breaker.reset_after = 1
+    scenarios = [
+        ('healthy', []),
+        ('429, Retry-After 1 s', [dict(status=429, retry_after=1)]),
+        ('2 x 503', [dict(status=503, count=2)]),
+        ('hung response', [dict(delay=2)]),
+        ('outage, 500s', [dict(status=500, count=20)]),
+        ('outage continues', None),
+        ('breaker open', None),
+        ('after cool-off', []),
+    ]
+    results = []
+    try:
+        for name, faults in scenarios:
+            if name == 'after cool-off':
+                time.sleep(player.api.breaker.reset_after)
+            if faults is not None:  # None leaves the queued faults in place
+                fake.faults = []
+                for fault in faults:
+                    fake.inject(**fault)
+            seen = len(fake.requests)
+            start = time.monotonic()
+            ok = player.apply_volume(50)
+            results.append((name, ok, time.monotonic() - start, len(fake.requests) - seen))
+    finally:
+        fake.close()
+    return results
+
+
+def token_player(fake, session, cache_path, clock):
+    """player whose token comes from the fake token endpoint, starting from a fresh cached token"""
+    handler = spotify_auth.AtomicCacheFileHandler(cache_path=cache_path)
+    handler.save_token_to_cache({'access_token': 'initial', 'token_type': 'Bearer', 'expires_in': 3600,
+                                 'expires_at': clock() + 3600, 'refresh_token': 'refresh', 'scope': SCOPE})
+    oauth = SpotifyOAuth(client_id='id', client_secret='secret', redirect_uri='http://localhost:8080',
+                         scope=SCOPE, cache_handler=handler, requests_session=session)
+    oauth.OAUTH_TOKEN_URL = fake.token_url
+    PlayerStateMachine._instances.clear()
+    player = PlayerStateMachine(DEVICE_ID, session=session, tokens=spotify_auth.TokenManager(oauth, clock=clock))
+    player.sp.prefix = fake.url
+    return player
+
+
+def profile_token(latency, idle=3600):
+    """returns ([(label, tap seconds, calls)], token requests for 8 concurrent callers,
+    whether the cache file holds the current token)"""
+    fake = fake_spotify.FakeSpotify(devices=(DEVICE_ID,), latency=latency)
+    fake.active_device = DEVICE_ID
+    cache_path = os.path.join(tempfile.mkdtemp(), '.cache')
+    clock = FakeClock()
+    taps = []
+    try:
+        for label, background in (('lazy refresh', False), ('renewed ahead', True)):
+            session = fake_spotify.TimedSession()
+            player = token_player(fake, session, cache_path, clock)
+            player.play_music(ALBUM_ID, False)
+            for _ in range(0, idle, jukebox.TOKEN_INTERVAL):
+                clock.advance(jukebox.TOKEN_INTERVAL)
+                if background and player.token_due():
+                    player.refresh_token()  # what the jukebox's token task does
+            del session.calls[:]
+            start = time.perf_counter()
+            player.play_music(ALBUM_ID, False)
+            taps.append((label, time.perf_counter() - start, list(session.calls)))
+
+        clock.advance(idle)
+        issued = fake.tokens_issued
+        threads = [threading.Thread(target=player.tokens.get_access_token) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(cache_path) as f:
+            cached = json.load(f)["access_token"] == player.tokens.get_access_token()
+        return taps, fake.tokens_issued - issued, cached
+    finally:
+        fake.close()
+        if os.path.exists(cache_path):
+            os.unlink(cache_path)
+        os.rmdir(os.path.dirname(cache_path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'tap':
+        taps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.03
+        report('legacy play_music', profile_taps(legacy_play, taps, latency))
+        report('play_music', profile_taps(PlayerStateMachine.play_music, taps, latency))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'faults':
+        results = profile_faults()
+        print('budget %.1f s per call, breaker opens after %d outage errors' % (
+            player_module.BUTTON_BUDGET, spotify_http.BREAKER_THRESHOLD))
+        for name, ok, seconds, requests in results:
+            print('  %-22s %-6s %7.1f ms %2d request(s)' % (name, 'ok' if ok else 'failed', seconds * 1000, requests))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'token':
+        taps, refreshes, cached = profile_token(float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.03)
+        for label, seconds, calls in taps:
+            print('first tap after an hour, %-13s %6.1f ms: %s' % (
+                label, seconds * 1000, ', '.join('%s %s' % (method, path) for method, path, _, _ in calls)))
+        print('8 concurrent callers with an expired token: %d token request(s)' % refreshes)
+        print('token cache file up to date: %s' % cached)
+    else:
+        print('Usage: python3 spotify_profile.py tap [TAPS] [LATENCY-MS] | faults | token [LATENCY-MS]')
+        sys.exit(1)
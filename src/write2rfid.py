@@ -1,42 +1,210 @@
 # Spotify RFID Jukebox
 #
 # Author: Ben Chacko, 2024
-# Description: Helper script to write desired ID to MIFARE card
+# Description: Helper script to write desired ID to MIFARE card, or a Spotify URI as
+#              a direct-play card (see card_format.py) that needs no catalog entry
 #
+#              The batch mode provisions a stack of cards with one reader session: it
+#              takes the IDs or URIs from a JSON manifest (the album catalog, or a list)
+#              or a CSV file (first column), writes them to the cards in the
+#              order they are presented and reads every block back to verify it. Cards
+#              that already hold a pending ID are kept as they are, and a card that was
+#              already provisioned (by UID) is never written twice. The UID of every
+#              card is saved after each one, as the manifest entries with a "uid"
+#              added, so the output can be used as the catalog and an interrupted run
+#              carries on where it stopped.
 #
-# Usage: $ > python3 write2rfid.py <DESIRED-ID>
+# Usage: $ > python3 write2rfid.py <DESIRED-ID | SPOTIFY-URI>
+#        $ > python3 write2rfid.py batch <MANIFEST> [OUTPUT]
 #
 # Hardware: RC522 RFID HAT
 #             - https://seengreat.com/wiki/90/rc522-rfid-hat
 #           Raspberry Pi 3 Model B+
 #             - https://www.raspberrypi.com/products/raspberry-pi-3-model-b-plus/
 
-import module
+import csv
+import json
+import os
 import sys
+import tempfile
 import time
-import wiringpi
-
-rc = module.Rc522_api()
-rc.init()
-wiringpi.softPwmCreate(24,0,8)
-
-id = sys.argv[1]
-
-def play_buzzer():
-    wiringpi.digitalWrite(29,0)  # turn on red led
-    wiringpi.softPwmWrite(24, 5)
-    time.sleep(0.2)
-    wiringpi.digitalWrite(29,1)  # turn off red led
-    wiringpi.softPwmWrite(24,0)  # turn off buzzer
-    time.sleep(0.3)
-
-if (len(id) != 16) or (not id.isdigit()):
-    print("Error: ID must be numerical and exactly 16 characters in length!")
-    exit(1)
-
-print("Ready to write to RFID card...")
-while True:
-    if rc.write(rc.block_num, id): # attempt to write to MIFARE card
-        play_buzzer()
-        print("Success: " + str(id) + " saved to card")
-        break
+
+import card_format
+import feedback
+import module
+
+BATCH_OUTPUT = "cards.json"
+POLL_INTERVAL = 0.05  # seconds between looks for the next card
+
+
+def valid(id):
+    return len(id) == 16 and id.isdigit()
+
+
+def entry_for(value):
+    """manifest entry for an ID or a Spotify URI"""
+    return {"uri": value} if value.startswith("spotify:") else {"rfid": value}
+
+
+def key(entry):
+    return entry.get("uri") or str(entry.get("rfid", ""))
+
+
+def payload(entry):
+    """what goes on the card: the 16 digits, or the direct-play payload of the URI"""
+    if "uri" in entry:
+        return card_format.encode(entry["uri"])
+    if not valid(str(entry.get("rfid", ""))):
+        raise card_format.CardFormatError("not a 16 digit ID: " + str(entry.get("rfid")))
+    return entry["rfid"]
+
+
+def load_manifest(path):
+    """manifest entries as dicts with an "rfid" ID or a "uri", from a JSON list of objects
+    or values, or from a CSV file with the value in the first column (a header row is skipped)"""
+    if path.endswith(".json"):
+        with open(path) as f:
+            entries = json.load(f)
+        return [dict(entry) if isinstance(entry, dict) else entry_for(str(entry)) for entry in entries]
+    with open(path, newline="") as f:
+        rows = [row for row in csv.reader(f) if row]
+    if rows and not valid(rows[0][0].strip()) and not rows[0][0].strip().startswith("spotify:"):
+        rows = rows[1:]
+    return [entry_for(row[0].strip()) for row in rows]
+
+
+def save_output(path, entries):
+    """write the entries atomically, a crash never leaves a truncated file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+        json.dump(entries, f, indent=2)
+    os.replace(f.name, path)
+
+
+def provision(rc, pending, done):
+    """one look at the reader: returns (uid, entry, status) where status is None when
+    there is no card, "done" for a card provisioned before, "kept" for a card that
+    already holds a pending ID, "written" after a verified write of pending[0] and
+    "failed" when the write or the read back failed"""
+    status = rc.pcd_request(module.PICC_REQALL)
+    if status == module.MI_OK:
+        status = rc.pcd_anticoll()
+    if status != module.MI_OK:
+        return None, None, None
+    uid = bytes(rc.SN)
+    if uid.hex() in done:
+        return uid, done[uid.hex()], "done"
+    if rc.pcd_select() != module.MI_OK or rc.auth_payload() != module.MI_OK:
+        return uid, None, "failed"
+    # a card written earlier (e.g. by a run that was interrupted) only needs its UID recorded
+    if rc.read_payload(rc.block_num) == module.MI_OK:
+        for entry in pending:
+            if rc.RFID == bytes(int(d) for d in payload(entry)):
+                rc.pcd_halt()
+                return uid, entry, "kept"
+    entry = pending[0]
+    data = payload(entry)
+    if rc.write_payload(rc.block_num, data) == module.MI_OK and \
+            rc.read_payload(rc.block_num) == module.MI_OK and rc.RFID == bytes(int(d) for d in data):
+        rc.pcd_halt()
+        return uid, entry, "written"
+    return uid, entry, "failed"
+
+
+def batch(rc, signals, manifest, output=BATCH_OUTPUT):
+    entries = load_manifest(manifest)
+    bad = []
+    for entry in entries:
+        try:
+            payload(entry)
+        except card_format.CardFormatError as e:
+            bad.append(str(e))
+    if bad:
+        print("Error: IDs must be numerical and exactly 16 characters in length, or Spotify URIs: " + "; ".join(bad))
+        return 1
+    # carry on from an earlier run writing to the same output
+    if os.path.exists(output):
+        with open(output) as f:
+            uids = dict((key(entry), entry["uid"]) for entry in json.load(f) if entry.get("uid"))
+        for entry in entries:
+            if key(entry) in uids:
+                entry["uid"] = uids[key(entry)]
+    done = dict((entry["uid"], entry) for entry in entries if entry.get("uid"))
+    pending = [entry for entry in entries if not entry.get("uid")]
+    print("%d card(s) to write, %d already done" % (len(pending), len(done)))
+
+    start = time.monotonic()
+    cards = 0
+    last = None  # uid of the card reported last, so a card left on the reader is reported once
+    prompted = False
+    while pending:
+        if not prompted:
+            print("Place card for %s (%d left)..." % (key(pending[0]), len(pending)))
+            signals.play(feedback.WRITING)
+            prompted = True
+        uid, entry, status = provision(rc, pending, done)
+        if status is None or uid == last:
+            time.sleep(POLL_INTERVAL)
+            continue
+        last = uid
+        if status == "done":
+            print("Card %s already holds %s, take it off" % (uid.hex(), key(entry)))
+            continue
+        if status == "failed":
+            print("Error: card %s not written, present it again" % uid.hex())
+            signals.play(feedback.ERROR)
+            last = None
+            time.sleep(POLL_INTERVAL)
+            continue
+        entry["uid"] = uid.hex()
+        done[uid.hex()] = entry
+        pending.remove(entry)
+        cards += 1
+        save_output(output, entries)
+        signals.play(feedback.SUCCESS)
+        print("Success: %s %s card %s" % (key(entry), "saved to" if status == "written" else "already on", uid.hex()))
+        prompted = False
+
+    if cards:
+        elapsed = time.monotonic() - start
+        print("%d card(s) in %.0f s, %.1f cards per minute" % (cards, elapsed, cards / elapsed * 60 if elapsed else 0))
+    print("UID mapping saved to " + output)
+    return 0
+
+
+def write_one(rc, signals, id):
+    try:
+        data = payload(entry_for(id))
+    except card_format.CardFormatError:
+        print("Error: ID must be numerical and exactly 16 characters in length, or a Spotify URI!")
+        return 1
+
+    print("Ready to write to RFID card...")
+    signals.play(feedback.WRITING)
+    while True:
+        if rc.write(rc.block_num, data): # attempt to write to MIFARE card
+            signals.play(feedback.SUCCESS)
+            print("Success: " + str(id) + " saved to card")
+            break
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or (sys.argv[1] == "batch" and len(sys.argv) < 3):
+        print("Usage: python3 write2rfid.py <DESIRED-ID | SPOTIFY-URI>")
+        print("       python3 write2rfid.py batch <MANIFEST> [OUTPUT]")
+        sys.exit(1)
+
+    rc = module.Rc522_api()
+    rc.init()
+    signals = feedback.Feedback(feedback.WiringPiPins())
+    try:
+        if sys.argv[1] == "batch":
+            code = batch(rc, signals, sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else BATCH_OUTPUT)
+        else:
+            code = write_one(rc, signals, sys.argv[1])
+    except KeyboardInterrupt:
+        code = 1
+    signals.wait_idle(1)  # let the buzzer finish before exiting
+    signals.close()
+    sys.exit(code)